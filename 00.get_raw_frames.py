@@ -9,18 +9,24 @@
 #--------------------------------------------------------------------------#
 
 import glob
-import cv2
 import os
 import pandas as pd
 import tarfile
 
+import lib.frames as frames
+
 
 ## Settings
 # avi files directory 
 target = '/remote/complex/tpanaiotis/raw_visufront/cross_current_7/'
 
-# create directory to store raw frames
-os.makedirs('data/raw_frames', exist_ok=True)
+# directory to store raw frames
+frames_dir = 'data/raw_frames'
+
+# seek to the next frame to extract rather than decode all frames up to it when it is more than max_gap frames away
+max_gap = 100
+# number of worker processes, each extracting frames from one avi file at a time (1 to process avi files sequentially)
+n_workers = 1
 
 # initiate empty dataframe to store avi names and frames
 avi_frames = pd.DataFrame()
@@ -65,29 +71,10 @@ assert all([x == 5 for x in frames_per_img]), 'At least one image does not have
 avi_files = avi_frames['avi_file'].drop_duplicates().tolist()
 avi_files.sort()
 
-# Join with path to avi files directory
-avi_files = [os.path.join(target, f) for f in avi_files]
-
-# Loop over avi files
-for avi in avi_files:
+# Frames to extract, per avi file, with path to avi files directory
+avi_frames = {os.path.join(target, f): avi_frames[avi_frames['avi_file'] == f]['frame_nb'].tolist() for f in avi_files}
 
-    # Get relevant frames for this file
-    frames = avi_frames[avi_frames['avi_file'] == os.path.basename(avi)]['frame_nb'].tolist()
-    
-    # open file and reset frame counter
-    cap = cv2.VideoCapture(avi)
-    
-    # loop over frames to process
-    for i in frames:
-        # go to frame i
-        cap.set(1, i)
-        # read frame
-        ret, frame = cap.read()
-        # save frame
-        frame_name = os.path.basename(avi) + '_frame_' + str(i) + '.png'
-        cv2.imwrite(os.path.join('data/raw_frames', frame_name), frame)
-    
-    # Close avi file
-    cap.release()
+# Extract frames, decoding each avi file forward
+missing = frames.run(avi_frames, output_dir = frames_dir, n_workers = n_workers, max_gap = max_gap)
 
 print('Finished')
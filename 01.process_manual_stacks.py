@@ -8,23 +8,35 @@
 # Author: Thelma Panaiotis
 #--------------------------------------------------------------------------#
 
-import numpy as np
 import glob
 import os
 import matplotlib.pyplot as plt
-import tarfile
-import shutil
 
 # Import modified apeep scripts (https://github.com/jiho/apeep)
 import lib.configure as configure
-import lib.im_opencv as im
-import lib.segment as segment
-import lib.measure as measure
+import lib.manual as manual
 
 #from importlib import reload
 
 min_area = 50
 alpha_threshold = 100
+# store decoded psd layers as .npy files next to the stacks, to skip decoding them in later runs
+psd_cache = False
+# compare one pixel every orientation_step rows and columns to check whether corrected stacks are flipped (1 to compare all pixels)
+orientation_step = 8
+# how to identify particles: 'md5' (as in apeep), 'blake2b' or 'xxhash' (faster, see measure.particle_id)
+id_scheme = 'md5'
+# write particles and their properties in a tar archive per image (True) or in a directory per image (False)
+write_tar = True
+# number of threads to encode particles images with, when writing tar archives
+write_threads = 4
+# also write properties of all particles in a single table, for bulk export: 'tsv', 'parquet' or None
+all_props_format = 'tsv'
+# gather particles of all images in a zip archive for Ecotaxa import
+import_zip = True
+# number of worker processes to process stacks (1 to process them sequentially)
+# NB: each stack is processed independently, a failure on one stack does not stop the others
+n_workers = 1
 
 ## Read from apeep config file for regular segmentation
 project_dir = 'data/regular_apeep'
@@ -46,64 +58,26 @@ man_stacks.sort()
 
 # Directory to write manual segments
 segmented_image_dir = os.path.join(manual_dir, 'segmented')
-os.makedirs(segmented_image_dir, exist_ok=True)
+# Directory to write particles, and the Ecotaxa import of all particles
+particles_dir = os.path.join(manual_dir, 'particles')
 
-# Loop over manual stacks to process
-for i, psd_file in enumerate(man_stacks):
-#psd_file = man_stacks[0]
 
-    # Extract image name
-    img_name = psd_file.split('/')[-2]
-    
-    # Extract back and mask from psd image
-    back, mask = segment.split_psd(psd_file, min_area = min_area, alpha_threshold = alpha_threshold)
-    #plt.figure(figsize = (20, 20));plt.imshow(back, cmap ='gray' ); plt.show()
-     
-    # Extract back and mask from original psd image
-    back_orig, _ = segment.split_psd(psd_file.replace('Sans titre', 'frame'), min_area = min_area, alpha_threshold = alpha_threshold)
-    #plt.figure(figsize = (20, 20));plt.imshow(back_orig, cmap ='gray' ); plt.show()
-    
-    # If back from original and corrected images are different, vertically flip both corrected back and mask
-    # NB: vertical flip because 'split_psd' function rotates back and mask of 90° counter clockwise
-    if not (back_orig == back).all():
-        back = np.flipud(back)
-        mask = np.flipud(mask)    
-        print(f'Flipping image {img_name}')
-        
-    # Write mask
-    #measure.write_segmented(mask, os.path.join(segmented_image_dir, img_name + '.png'))
-    im.save(mask == 0, os.path.join(segmented_image_dir, img_name + '.png'))
-    
-    # If particles are found in psd image, process it
-    if np.sum(mask) > 0:
-        # Extract particles and their properties
-        particles, particles_props = measure.measure(
-            img = back, 
-            img_labelled = mask, 
-            img_name = img_name, 
-            sample_id = transect_name, 
-            props = cfg['measure']['properties']
-        )
-        
-        # Write particles and properties
-        particles_images_dir = os.path.join(manual_dir, 'particles', img_name)
-        os.makedirs(particles_images_dir, exist_ok=True)
-        
-        # write particles images
-        measure.write_particles(particles, particles_images_dir, px2mm=cfg['acq']['window_height_mm']/img_width)      
-        # and properties
-        measure.write_particles_props(particles_props, particles_images_dir)
-        
-        
-        ## Create a tar archive containing particles and properties 
-        #with tarfile.open(particles_images_dir + '.tar', 'w') as tar:
-        #    tar.add(particles_images_dir, arcname=os.path.basename(particles_images_dir))
-        #    tar.close()
-        
-        # Delete directory 
-        #shutil.rmtree(particles_images_dir)
-        print(f'Done image {img_name}')
-    
-    # Progress flag
-    if (i+1)%10==0:
-        print(f'Done with {i+1} out of {len(man_stacks)}')
+# Process all stacks, write segmented images, particles and their properties
+manual.run(
+    man_stacks = man_stacks, 
+    segmented_image_dir = segmented_image_dir, 
+    particles_dir = particles_dir, 
+    n_workers = n_workers, 
+    all_props_format = all_props_format, 
+    import_zip = import_zip, 
+    sample_id = transect_name, 
+    props = cfg['measure']['properties'], 
+    px2mm = cfg['acq']['window_height_mm']/img_width, 
+    min_area = min_area, 
+    alpha_threshold = alpha_threshold, 
+    psd_cache = psd_cache, 
+    orientation_step = orientation_step, 
+    id_scheme = id_scheme, 
+    write_tar = write_tar, 
+    write_threads = write_threads
+)
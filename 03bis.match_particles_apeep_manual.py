@@ -9,20 +9,15 @@
 #--------------------------------------------------------------------------#
 
 
-# 1. look for bbox intersection 
-# 2. look for mask overlap
+# look for mask overlap, for all pairs of particles at once
+# and report bbox iou, mask iou and dice of overlapping particles
 
 import os
 import glob
 import pandas as pd
 import numpy as np
-import cv2
-import matplotlib.pyplot as plt
-import skimage.measure
 
-import lib.measure as measure
-import lib.im_opencv as im
-import lib.matching as matching
+import lib.driver as driver
 
 #from importlib import reload
 
@@ -30,145 +25,76 @@ import lib.matching as matching
 manual_dir = 'data_cc4/manual' # path to manual data dir
 reg_apeep_dir = 'data_cc4/apeep_cc4_er2' # path to regular apeep data dir
 
+# Automatic pipelines to match with manual particles, keyed by the prefix used in output files
+pipelines = {
+    'reg': reg_apeep_dir,
+}
+
 ## Output directory
 output_dir = 'data_cc4/matches'
 os.makedirs(output_dir, exist_ok=True)
+# format of output tables: 'csv' or 'parquet'
+output_format = 'csv'
+
+## Matching settings
+# value to match particles on: 'bbox_iou', 'mask_iou' or 'mask_dice'
+match_on = 'mask_iou'
+# particles are matched when this value is above threshold (0 with 'mask_iou' means any overlapping pixel)
+match_threshold = 0
+# thresholds to compute precision and recall for, from the same candidate matches
+sweep_thresholds = np.round(np.arange(0.05, 0.95, 0.05), 2)
+
+## Cache of labelled masks
+# segmented images are labelled once and stored there, keyed by their content, to skip decoding and labelling them in later runs (None to disable)
+mask_cache_dir = 'data_cc4/mask_cache'
+
+## Parallel processing
+# number of worker processes to process images (1 to process them sequentially)
+n_workers = 1
+# when processing images sequentially, number of images which masks are read in advance while the current one is matched (0 to disable)
+prefetch = 2
+
+## Incremental processing
+# when True, only reprocess images whose input files changed since the last run, and reuse stored results for the others
+incremental = True
+# how to detect changes in input files: 'mtime' (size and modification time) or 'hash' (md5 of content)
+manifest_method = 'mtime'
 
 
-# Initiate empty dict to store matches
-# with regular particles
-matches_reg = {
-    'img_name': [],
-    'man_ids': [],
-    'reg_ids': [],
-}
-
-# Initiate empty dataframes to store all particles props
-all_man_particles_props = pd.DataFrame()
-all_reg_particles_props = pd.DataFrame()
-
 # List segmented images to process
 man_segments = glob.glob(os.path.join(manual_dir, 'segmented', '*'))
 man_segments.sort()
 #len(man_segments)
 
 # Read ecotaxa export with objects taxo
-eco_exp = pd.read_csv('data_cc4/manual/ecotaxa_export_test_set.csv')
+ecotaxa_file = 'data_cc4/manual/ecotaxa_export_test_set.csv'
+eco_exp = pd.read_csv(ecotaxa_file)
 # rename colums
 eco_exp = eco_exp.rename(columns = {
-    'object_id': 'eco_object_id',
     'img_name': 'acq_id',
     'bbox0': 'object_bbox-0',
     'bbox1': 'object_bbox-1',
     'bbox2': 'object_bbox-2',
     'bbox3': 'object_bbox-3'
 })
-
-
-
-# Loop over segmented images
-for en, img_path in enumerate(man_segments):
-    # get image name
-    img_name = os.path.split(img_path)[-1]
-    
-    # Read background image
-    back = im.read(os.path.join(reg_apeep_dir, 'enhanced', img_name))
-    #plt.figure(figsize = (20, 20)); plt.imshow(back, cmap = 'gray'); plt.show()
-
-    
-    ## Regular apeep particles
-    # read regular apeep mask
-    reg_mask = im.read_mask(os.path.join(reg_apeep_dir, 'segmented', img_name))
-    # extract particles and their properties
-    reg_particles, reg_particles_props = measure.measure(
-        img = back, 
-        img_labelled = reg_mask, 
-        img_name = img_name.replace('.png',''), 
-        sample_id = '', 
-        props = ['label', 'bbox', 'area']
-    )
-    # drop useless columns
-    reg_particles_props = reg_particles_props[['object_id', 'acq_id', 'object_label', 'object_bbox-0', 'object_bbox-1', 'object_bbox-2', 'object_bbox-3', 'object_area']]
-    # add to all regular particles props
-    all_reg_particles_props = pd.concat([all_reg_particles_props, reg_particles_props])
-   
-
-    ## Manual particles
-    # read manual mask
-    man_mask = im.read_mask(img_path)
-    # if particles are present in mask (NB: check this only for manual mask, particles will always be found in apeep mask)
-    if np.sum(man_mask) > 0: 
-        # extract particles and their properties
-        man_particles, man_particles_props = measure.measure(
-            img = back, 
-            img_labelled = man_mask, 
-            img_name = img_name.replace('.png',''), 
-            sample_id = '', 
-            props = ['label', 'bbox', 'area']
-        )
-        # drop useless columns
-        man_particles_props = man_particles_props[['object_id', 'acq_id', 'object_label', 'object_bbox-0', 'object_bbox-1', 'object_bbox-2', 'object_bbox-3', 'object_area']]
-        # join with ecotaxa taxonomy based on bbox and acq_id (image name)
-        man_particles_props = man_particles_props.merge(eco_exp).drop('eco_object_id', axis=1)
-        # add to all manual particles props
-        all_man_particles_props = pd.concat([all_man_particles_props, man_particles_props])
-
-
-        # Loop over manual particles
-        for i in man_particles_props.index:
-        
-            # get manual particle label, id and bbox
-            man_label = man_particles_props.loc[i, 'object_label']
-            man_id    = man_particles_props.loc[i, 'object_id']
-            man_bb0   = man_particles_props.loc[i, 'object_bbox-0']
-            man_bb1   = man_particles_props.loc[i, 'object_bbox-1']
-            man_bb2   = man_particles_props.loc[i, 'object_bbox-2']
-            man_bb3   = man_particles_props.loc[i, 'object_bbox-3']
-            
-            man_bb = [man_bb0, man_bb1, man_bb2, man_bb3]
-            
-            ## Look for match with regular particles
-            # loop over regular particles
-            for j in reg_particles_props.index:
-                # get regular particle label, id and bbox
-                reg_label = reg_particles_props.loc[j, 'object_label']
-                reg_id    = reg_particles_props.loc[j, 'object_id']
-                reg_bb0   = reg_particles_props.loc[j, 'object_bbox-0']
-                reg_bb1   = reg_particles_props.loc[j, 'object_bbox-1']
-                reg_bb2   = reg_particles_props.loc[j, 'object_bbox-2']
-                reg_bb3   = reg_particles_props.loc[j, 'object_bbox-3']
-                
-                reg_bb = [reg_bb0, reg_bb1, reg_bb2, reg_bb3]
-                
-                # check for bbox intercept
-                bbox_intersect = matching.check_bbox_overlap(man_bb, reg_bb)
-                if bbox_intersect:                
-                    # if bbox intersect, check for mask overlap
-                    mask_overlap = np.any((man_mask == man_label) & (reg_mask == reg_label))
-                    
-                    if mask_overlap:
-                        # if masks do overlap, save particles ids
-                        matches_reg['img_name'].append(img_name.replace('.png',''))
-                        matches_reg['man_ids'].append(man_id)
-                        matches_reg['reg_ids'].append(reg_id)
-                        
-    
-    # Progress flag
-    print(f'{img_name} done')
-    if (en+1)%10 == 0:
-        print(f'Done with {en+1} out of {len(man_segments)}')
-    
-
-# when all images are processed, convert to a dataframe
-matches_reg = pd.DataFrame(matches_reg)
-#matches_sem = pd.DataFrame(matches_sem)
-
-## Write all dataframes
-os.makedirs(os.path.join(manual_dir, 'matches'), exist_ok=True)
-# particles
-all_man_particles_props.to_csv(os.path.join(output_dir, 'man_particles_props.csv'), index = False)
-all_reg_particles_props.to_csv(os.path.join(output_dir, 'reg_particles_props.csv'), index = False)
-#all_sem_particles_props.to_csv(os.path.join(output_dir, 'sem_particles_props.csv'), index = False)
-# matches
-matches_reg.to_csv(os.path.join(output_dir, 'matches_reg.csv'), index = False)
-#matches_sem.to_csv(os.path.join(output_dir, 'matches_sem.csv'), index = False)
+# drop ecotaxa ids, to keep ids of measured manual particles
+eco_exp = eco_exp.drop('object_id', axis=1)
+
+
+# Match manual particles with regular particles and write all dataframes
+driver.run(
+    man_segments = man_segments, 
+    pipelines = pipelines, 
+    eco_exp = eco_exp, 
+    output_dir = output_dir, 
+    ecotaxa_file = ecotaxa_file, 
+    match_on = match_on, 
+    match_threshold = match_threshold, 
+    sweep_thresholds = sweep_thresholds, 
+    n_workers = n_workers, 
+    incremental = incremental, 
+    manifest_method = manifest_method, 
+    output_format = output_format, 
+    cache_dir = mask_cache_dir, 
+    prefetch = prefetch
+)
@@ -0,0 +1,89 @@
+#
+# Content-addressed cache of labelled masks
+#
+
+import os
+
+import numpy as np
+
+import lib.im_opencv as im
+import lib.measure as measure
+import lib.manifest as manifest
+
+def cache_path(path, cache_dir, compress=True):
+    """
+    Get the path of the cached version of a mask
+
+    The cache is addressed by the md5 checksum of the content of the mask image, so
+    that a changed image is never read from the cache, and identical images (e.g.
+    copies used by several stages) share the same entry.
+
+    Args:
+        path (str): path to the mask image
+        cache_dir (str): directory of the cache
+        compress (bool): whether entries are compressed (.npz) or memory-mappable (.npy)
+
+    Returns:
+        (str) path to the cache entry, without extension when not compressed
+    """
+    key = manifest.file_signature(path, method='hash')
+    if compress:
+        return(os.path.join(cache_dir, key + '.npz'))
+    else:
+        return(os.path.join(cache_dir, key))
+
+def read_mask(path, cache_dir, compress=True):
+    """
+    Read a mask image with labelled particles, and the label, bbox and area of particles, through a cache
+
+    When the image was not read before, it is decoded and labelled with im.read_mask,
+    in compact form, particles are measured with measure.label_stats, and all are stored
+    in the cache. Following reads skip decoding, labelling and measuring.
+
+    Args:
+        path (str): path to the mask image
+        cache_dir (str): directory of the cache
+        compress (bool): store entries as one compressed .npz file (smaller), or as
+            uncompressed .npy files, the mask of which is memory-mapped when read (faster)
+            (default is True)
+
+    Returns:
+        mask (ndarray): labelled mask, of the smallest unsigned integer type which fits its labels
+        stats (dict): label, bbox and area of particles, see measure.label_stats
+    """
+    entry = cache_path(path, cache_dir, compress=compress)
+
+    # read from cache when possible
+    if compress and os.path.exists(entry):
+        with np.load(entry) as z:
+            mask = z['mask']
+            stats = {k: z[k] for k in ('label', 'bbox', 'area')}
+        return(mask, stats)
+    if not compress and os.path.exists(entry + '_stats.npz'):
+        mask = np.load(entry + '_mask.npy', mmap_mode='r')
+        with np.load(entry + '_stats.npz') as z:
+            stats = {k: z[k] for k in ('label', 'bbox', 'area')}
+        return(mask, stats)
+
+    # otherwise read, label and measure the mask
+    mask = im.read_mask(path, compact=True)
+    stats = measure.label_stats(mask)
+
+    # and store it
+    # NB: write to temporary files and rename them, so that concurrent workers never read partial entries
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = entry + '.' + str(os.getpid()) + '.tmp'
+    if compress:
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, mask=mask, **stats)
+        os.replace(tmp, entry)
+    else:
+        # NB: write the mask first, stats are written last and mark the entry as complete
+        with open(tmp, 'wb') as f:
+            np.save(f, mask)
+        os.replace(tmp, entry + '_mask.npy')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **stats)
+        os.replace(tmp, entry + '_stats.npz')
+
+    return(mask, stats)
@@ -0,0 +1,404 @@
+#
+# Match manual particles with those of any number of automatic pipelines
+#
+
+import os
+import time
+import functools
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import lib.im_opencv as im
+import lib.measure as measure
+import lib.matching as matching
+import lib.manifest as manifest
+import lib.sink as sink
+import lib.cache as cache
+
+# Names of bbox columns in particles properties
+bbox_cols = ['object_bbox-0', 'object_bbox-1', 'object_bbox-2', 'object_bbox-3']
+
+# Columns of particles properties to keep
+man_props_cols = ['object_id', 'acq_id', 'object_label'] + bbox_cols + ['object_area']
+props_cols = man_props_cols + ['diag_bbox']
+
+# Minimum time between writes of the manifest while processing images, in seconds
+# NB: an interrupted run then reprocesses at most the images of the last few seconds
+manifest_interval = 10
+
+def read_labelled(mask_path, cache_dir=None):
+    """
+    Read and label a segmented image
+
+    Args:
+        mask_path (str): path to the segmented image
+        cache_dir (str): directory of the cache of labelled masks, see cache.read_mask;
+            None to always read and label the mask
+
+    Returns:
+        mask (ndarray): labelled mask
+        stats (dict): label, bbox and area of particles when read from the cache, None otherwise
+    """
+    # NB: masks are only used to match particles, labels are stored compactly
+    if cache_dir is None:
+        mask = im.read_mask(mask_path, compact=True)
+        stats = None
+    else:
+        mask, stats = cache.read_mask(mask_path, cache_dir)
+    return(mask, stats)
+
+def read_image_masks(img_path, pipelines, cache_dir=None):
+    """
+    Read and label the manual mask of an image and the masks of all pipelines
+
+    Args:
+        img_path (str): path to the manual segmented image
+        pipelines (dict): directory of each automatic pipeline, keyed by prefix
+        cache_dir (str): directory of the cache of labelled masks, see cache.read_mask
+
+    Returns:
+        dict: of (mask, stats) as returned by read_labelled, keyed by path
+    """
+    paths = input_files(img_path, pipelines)
+    return({p: read_labelled(p, cache_dir=cache_dir) for p in paths})
+
+def read_particles(img_name, mask_path, cache_dir=None, labelled=None):
+    """
+    Read a segmented image and measure its particles
+
+    Args:
+        img_name (str): name of image, without extension
+        mask_path (str): path to the segmented image
+        cache_dir (str): directory of the cache of labelled masks, see cache.read_mask;
+            None to always read and label the mask
+        labelled (tuple): (mask, stats) already read with read_labelled, None to read it
+
+    Returns:
+        mask (ndarray): labelled mask
+        particles_props (dataframe): properties of particles (id, label, bbox, area)
+    """
+    # read mask, and the bbox and area of its particles when cached
+    if labelled is None:
+        labelled = read_labelled(mask_path, cache_dir=cache_dir)
+    mask, stats = labelled
+    # measure particles, without extracting them
+    particles_props = measure.measure_props(
+        img_labelled = mask,
+        img_name = img_name,
+        sample_id = '',
+        stats = stats
+    )
+    return(mask, particles_props)
+
+def match_pipeline(img_name, man_particles_props, man_mask, particles_props, mask, prefix, match_on='bbox_iou', match_threshold=0.1):
+    """
+    Match manual particles with particles from one automatic pipeline
+
+    Args:
+        img_name (str): name of image
+        man_particles_props (dataframe): properties of manual particles
+        man_mask (ndarray): labelled manual mask
+        particles_props (dataframe): properties of automatic particles
+        mask (ndarray): labelled automatic mask
+        prefix (str): prefix of the pipeline, used to name the column of automatic ids
+        match_on (str): value to match particles on, see matching.match_particles
+        match_threshold (float): particles are matched when match_on is above this value
+
+    Returns:
+        matches (dataframe): matches above threshold, with their matching values
+        candidates (dataframe): all candidate matches, with their matching value, for the threshold sweep
+    """
+    # find all candidate matches and compute their bbox iou, mask iou and dice
+    candidates = matching.match_particles(
+        bb_a = man_particles_props[bbox_cols].to_numpy(),
+        bb_b = particles_props[bbox_cols].to_numpy(),
+        mask_a = man_mask,
+        mask_b = mask,
+        labels_a = man_particles_props['object_label'].to_numpy(),
+        area_a = man_particles_props['object_area'].to_numpy(),
+        labels_b = particles_props['object_label'].to_numpy(),
+        area_b = particles_props['object_area'].to_numpy(),
+        match_on = match_on,
+        threshold = 0
+    )
+    man_ids = man_particles_props['object_id'].to_numpy()[candidates['idx_a']]
+    ids = particles_props['object_id'].to_numpy()[candidates['idx_b']]
+
+    # store ids and matching value of candidates
+    candidates_df = pd.DataFrame({
+        'man_ids': man_ids,
+        prefix + '_ids': ids,
+        'score': candidates[match_on],
+    })
+
+    # keep candidates above threshold as matches
+    is_match = candidates[match_on] > match_threshold
+    matches = pd.DataFrame({
+        'img_name': img_name,
+        'man_ids': man_ids[is_match],
+        prefix + '_ids': ids[is_match],
+        'bbox_iou': candidates['bbox_iou'][is_match],
+        'mask_iou': candidates['mask_iou'][is_match],
+        'mask_dice': candidates['mask_dice'][is_match],
+    })
+    # flag matches which are part of the one-to-one assignment of this image
+    matches['assigned'] = matching.assign_one_to_one(candidates['idx_a'][is_match], candidates['idx_b'][is_match], candidates[match_on][is_match])
+
+    return(matches, candidates_df)
+
+def match_image(img_path, pipelines, eco_exp, match_on='bbox_iou', match_threshold=0.1, cache_dir=None, labelled=None):
+    """
+    Extract manual particles from one image and match them with those of all pipelines
+
+    The manual mask is read, labelled and measured once, and then matched with the
+    particles of every pipeline. Only masks are needed: particles are matched on their
+    position and shape, not on their content.
+
+    Args:
+        img_path (str): path to the manual segmented image
+        pipelines (dict): directory of each automatic pipeline, keyed by prefix (e.g. 'reg');
+            segmented images are in the 'segmented' subdirectory of each
+        eco_exp (dataframe): Ecotaxa export of manual particles, with taxonomy, to join on
+            acq_id and bbox; when it contains an 'object_id' column, it is used as the id of
+            manual particles
+        match_on (str): value to match particles on, see matching.match_particles
+        match_threshold (float): particles are matched when match_on is above this value
+        cache_dir (str): directory of the cache of labelled masks, see cache.read_mask
+        labelled (dict): masks already read with read_image_masks, None to read them
+
+    Returns:
+        dict: of dataframes with particles properties, matches, one-to-one assignments
+            and candidate matches, named after the pipelines prefixes
+    """
+    # get image name
+    img_name = os.path.split(img_path)[-1]
+    name = img_name.replace('.png','')
+
+    # read all masks, unless they were read in advance
+    if labelled is None:
+        labelled = read_image_masks(img_path, pipelines, cache_dir=cache_dir)
+
+    ## Manual particles
+    # read manual mask and measure its particles
+    man_mask, man_particles_props = read_particles(name, img_path, labelled=labelled[img_path])
+    # if particles are present in mask (NB: check this only for manual mask, particles will always be found in automatic masks)
+    if len(man_particles_props) > 0:
+        # drop useless columns, and measured ids when ids come from ecotaxa
+        man_particles_props = man_particles_props[man_props_cols]
+        if 'object_id' in eco_exp.columns:
+            man_particles_props = man_particles_props.drop('object_id', axis=1)
+        # join with ecotaxa taxonomy based on bbox and acq_id (image name)
+        man_particles_props = man_particles_props.merge(eco_exp)
+        # reorder columns in manual properties
+        man_particles_props = man_particles_props.reindex(columns=(['object_id'] + list([a for a in man_particles_props.columns if a != 'object_id']) ))
+        res = {'man_particles_props': man_particles_props}
+    else:
+        # no manual particles, match with an empty table but do not write it
+        man_particles_props = pd.DataFrame(columns = man_props_cols)
+        res = {'man_particles_props': pd.DataFrame()}
+
+    ## Automatic particles, for each pipeline
+    for prefix, pipeline_dir in pipelines.items():
+        mask_path = os.path.join(pipeline_dir, 'segmented', img_name)
+        mask, particles_props = read_particles(name, mask_path, labelled=labelled[mask_path])
+        # compute bbox diagonal
+        particles_props['diag_bbox'] = np.sqrt((particles_props['object_bbox-2'] - particles_props['object_bbox-0'])**2 + \
+        (particles_props['object_bbox-3'] - particles_props['object_bbox-1'])**2)
+        # drop useless columns
+        particles_props = particles_props[props_cols]
+
+        # look for match with manual particles
+        matches, candidates = match_pipeline(name, man_particles_props, man_mask, particles_props, mask, prefix, match_on=match_on, match_threshold=match_threshold)
+
+        res[prefix + '_particles_props'] = particles_props
+        res['matches_' + prefix] = matches
+        res['assignments_' + prefix] = matches[matches['assigned']].drop('assigned', axis=1)
+        res['candidates_' + prefix] = candidates
+
+    return(res)
+
+def input_files(img_path, pipelines):
+    """
+    List the input files of one image, which changes trigger its reprocessing
+
+    Args:
+        img_path (str): path to the manual segmented image
+        pipelines (dict): directory of each automatic pipeline, keyed by prefix
+
+    Returns:
+        list: of paths
+    """
+    img_name = os.path.split(img_path)[-1]
+    return(
+        [img_path] + \
+        [os.path.join(d, 'segmented', img_name) for d in pipelines.values()]
+    )
+
+# Arguments of match_image in worker processes, set once per worker
+_worker_args = {}
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+    pass
+
+def _match_image_worker(img_path):
+    return(match_image(img_path, **_worker_args))
+
+def run(man_segments, pipelines, eco_exp, output_dir, ecotaxa_file=None,
+        match_on='bbox_iou', match_threshold=0.1, sweep_thresholds=np.round(np.arange(0.05, 0.95, 0.05), 2),
+        n_workers=1, incremental=True, manifest_method='mtime', output_format='csv', cache_dir=None, prefetch=2):
+    """
+    Match manual particles with those of all pipelines, for all images, and write results
+
+    Writes, in output_dir, the properties of manual particles and, for each pipeline,
+    the properties of its particles, its matches, one-to-one assignments and candidate
+    matches, as well as precision and recall for all sweep_thresholds (pr_sweep.csv).
+
+    Args:
+        man_segments (list): paths to manual segmented images
+        pipelines (dict): directory of each automatic pipeline, keyed by prefix (e.g. 'reg')
+        eco_exp (dataframe): Ecotaxa export of manual particles, see match_image
+        output_dir (str): directory to write results to
+        ecotaxa_file (str): path to the Ecotaxa export, to reprocess everything when it changes
+        match_on (str): value to match particles on, see matching.match_particles
+        match_threshold (float): particles are matched when match_on is above this value
+        sweep_thresholds (list): thresholds to compute precision and recall for
+        n_workers (int): number of worker processes to process images (1 to process them sequentially)
+        incremental (bool): only reprocess images whose input files changed since the last run
+        manifest_method (str): how to detect changes in input files, see manifest.file_signature
+        output_format (str): format of output tables, 'csv' or 'parquet'
+        cache_dir (str): directory of the cache of labelled masks, shared between runs and
+            scripts, see cache.read_mask; None to always read and label masks
+        prefetch (int): when processing images sequentially, number of images which masks are
+            read in advance, on background threads, while the current one is matched (0 to disable)
+
+    Returns:
+        Nothing
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    ## Find images to process
+    # results of each image are stored, along with a manifest of the signatures of their input files
+    per_image_dir = os.path.join(output_dir, 'per_image')
+    os.makedirs(per_image_dir, exist_ok=True)
+    manifest_file = os.path.join(output_dir, 'manifest.json')
+    def result_file(img_path):
+        return(os.path.join(per_image_dir, os.path.split(img_path)[-1].replace('.png', '.pkl')))
+
+    # settings which change the results of all images
+    run_settings = {
+        'match_on': match_on,
+        'match_threshold': match_threshold,
+        'pipelines': pipelines,
+        'ecotaxa_file': manifest.file_signature(ecotaxa_file, method = manifest_method) if ecotaxa_file else None
+    }
+    # compute signatures of inputs of all images
+    signatures = {os.path.split(p)[-1]: manifest.inputs_signature(input_files(p, pipelines), method = manifest_method) for p in man_segments}
+
+    # read the manifest of the previous run, ignore it when settings changed
+    previous = manifest.read(manifest_file) if incremental else {}
+    if previous.get('settings') != run_settings:
+        previous = {}
+    previous_images = previous.get('images', {})
+
+    # process images whose inputs changed, or which were not processed yet
+    to_process = [p for p in man_segments if previous_images.get(os.path.split(p)[-1]) != signatures[os.path.split(p)[-1]] or not os.path.exists(result_file(p))]
+    to_process_set = set(to_process)
+    print(f'{len(to_process)} images to process, {len(man_segments) - len(to_process)} reused from previous run')
+
+    # initiate manifest of this run with the images which are up to date
+    current = {
+        'settings': run_settings,
+        'images': {os.path.split(p)[-1]: signatures[os.path.split(p)[-1]] for p in man_segments if p not in to_process_set}
+    }
+    manifest.write(current, manifest_file)
+
+    ## Open output files
+    # each table of each image is appended to its file as soon as the image is processed
+    names = ['man_particles_props'] + \
+        [prefix + '_particles_props' for prefix in pipelines] + \
+        ['matches_' + prefix for prefix in pipelines] + \
+        ['assignments_' + prefix for prefix in pipelines] + \
+        ['candidates_' + prefix for prefix in pipelines]
+    sinks = {name: sink.TableSink(os.path.join(output_dir, name), format = output_format) for name in names}
+
+    ## Process images, in parallel if requested
+    args = {
+        'pipelines': pipelines,
+        'eco_exp': eco_exp,
+        'match_on': match_on,
+        'match_threshold': match_threshold,
+        'cache_dir': cache_dir
+    }
+    if n_workers > 1:
+        # NB: use fork, like mclapply in the R scripts, so that scripts calling this are not re-run in workers
+        pool = multiprocessing.get_context('fork').Pool(n_workers, initializer = _init_worker, initargs = (args,))
+        # imap returns results in the order of images, so writing is deterministic
+        results = pool.imap(_match_image_worker, to_process)
+    elif prefetch > 0:
+        # read the masks of the next images while the current one is matched
+        labelled = im.prefetch(to_process, functools.partial(read_image_masks, pipelines = pipelines, cache_dir = cache_dir), depth = prefetch)
+        results = (match_image(p, labelled = l, **args) for p, l in zip(to_process, labelled))
+    else:
+        results = (match_image(p, **args) for p in to_process)
+
+    # Loop over segmented images
+    # NB: the manifest is written regularly rather than after each image, and always once at the end
+    last_write = time.time()
+    try:
+        for en, img_path in enumerate(man_segments):
+            img_name = os.path.split(img_path)[-1]
+            if img_path in to_process_set:
+                # get results of this image
+                res = next(results)
+                # store them and record the signatures of their inputs
+                pd.to_pickle(res, result_file(img_path))
+                current['images'][img_name] = signatures[img_name]
+                if time.time() - last_write > manifest_interval:
+                    manifest.write(current, manifest_file)
+                    last_write = time.time()
+            else:
+                # reuse stored results
+                res = pd.read_pickle(result_file(img_path))
+
+            # write particles props, matches, assignments and candidates of this image
+            for name, table_sink in sinks.items():
+                table_sink.write(res[name])
+
+            # Progress flag
+            print(f'{img_name} done')
+            if (en+1)%10 == 0:
+                print(f'Done with {en+1} out of {len(man_segments)}')
+    finally:
+        manifest.write(current, manifest_file)
+
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+
+    for table_sink in sinks.values():
+        table_sink.close()
+
+    ## Precision and recall for all thresholds, from candidates written to disk
+    pr_sweep = []
+    for prefix in pipelines:
+        candidates = sink.read_table(sinks['candidates_' + prefix].path)
+        if len(candidates.columns) == 0:
+            # no candidate pairs were written (e.g. no images, or no overlapping particles): nothing is matched
+            candidates = pd.DataFrame({'man_ids': [], prefix + '_ids': [], 'score': []})
+        pr_sweep.append(pd.DataFrame(matching.precision_recall_sweep(
+            ids_a = candidates['man_ids'],
+            ids_b = candidates[prefix + '_ids'],
+            score = candidates['score'],
+            n_a = sinks['man_particles_props'].n_rows,
+            n_b = sinks[prefix + '_particles_props'].n_rows,
+            thresholds = sweep_thresholds
+        )).assign(pipeline = prefix))
+    pr_sweep = pd.concat(pr_sweep)
+    pr_sweep = pr_sweep[['pipeline'] + [c for c in pr_sweep.columns if c != 'pipeline']]
+    pr_sweep.to_csv(os.path.join(output_dir, 'pr_sweep.csv'), index = False)
+
+    pass
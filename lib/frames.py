@@ -0,0 +1,118 @@
+#
+# Extract raw frames from avi files
+#
+
+import os
+import multiprocessing
+
+import cv2
+
+def frame_name(avi, i):
+    """
+    Name of the image file of a frame
+
+    Args:
+        avi (str): path to the avi file
+        i (int): frame number, from 0
+
+    Returns:
+        (str) name of the image file
+    """
+    return(os.path.basename(avi) + '_frame_' + str(i) + '.png')
+
+def extract_frames(avi, frames, output_dir, max_gap=100):
+    """
+    Extract frames from an avi file and save them as images
+
+    Seeking in an avi file decodes from the previous keyframe, so that extracting frames
+    by seeking to each of them costs close to decoding the file as many times. Instead,
+    frames are extracted in order, decoding the file forward: frames in between are only
+    grabbed (decoded but not converted) and only wanted frames are retrieved. Seeking is
+    used only to skip gaps of more than max_gap frames.
+
+    Args:
+        avi (str): path to the avi file
+        frames (list): numbers of the frames to extract, from 0, in any order
+        output_dir (str): directory to save frames to, see frame_name
+        max_gap (int): seek to the next wanted frame rather than decoding forward when it
+            is more than max_gap frames away (default is 100)
+
+    Returns:
+        missing (list): numbers of frames which could not be read (e.g. beyond the end of the file)
+    """
+    # sort frames, to decode the file forward only, and extract each of them once
+    frames = sorted(set(frames))
+    missing = []
+
+    cap = cv2.VideoCapture(avi)
+    # number of the frame returned by the next grab
+    pos = 0
+    for i in frames:
+        # skip large gaps by seeking
+        if i - pos > max_gap:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+            pos = i
+        # otherwise decode forward up to the frame
+        ok = True
+        while ok and pos < i:
+            ok = cap.grab()
+            pos += 1
+        # read the frame itself
+        if ok:
+            ok = cap.grab()
+            pos += 1
+        if ok:
+            ok, frame = cap.retrieve()
+        if not ok:
+            # the end of the file was reached, following frames cannot be read either
+            missing += [f for f in frames if f >= i]
+            break
+        # save frame
+        cv2.imwrite(os.path.join(output_dir, frame_name(avi, i)), frame)
+    cap.release()
+
+    return(missing)
+
+def _extract_frames_worker(args):
+    avi, frames, output_dir, max_gap = args
+    return(avi, extract_frames(avi, frames, output_dir, max_gap=max_gap))
+
+def run(avi_frames, output_dir, n_workers=1, max_gap=100):
+    """
+    Extract frames from several avi files, in parallel if requested
+
+    Args:
+        avi_frames (dict): numbers of the frames to extract, keyed by path to the avi file
+        output_dir (str): directory to save frames to
+        n_workers (int): number of worker processes, each processing one avi file at a
+            time (1 to process them sequentially)
+        max_gap (int): seek rather than decode forward across larger gaps, see extract_frames
+
+    Returns:
+        missing (dict): numbers of frames which could not be read, keyed by path to the avi file
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(avi, frames, output_dir, max_gap) for avi, frames in avi_frames.items()]
+
+    if n_workers > 1:
+        # NB: use fork, like in the other scripts, so that the calling script is not re-run in workers
+        pool = multiprocessing.get_context('fork').Pool(n_workers)
+        # avi files are processed as workers become free, whatever their order
+        results = pool.imap_unordered(_extract_frames_worker, tasks)
+    else:
+        results = (_extract_frames_worker(task) for task in tasks)
+
+    missing = {}
+    for i, (avi, avi_missing) in enumerate(results):
+        if len(avi_missing) > 0:
+            print(f'Could not read {len(avi_missing)} frames from {avi}')
+            missing[avi] = avi_missing
+        # Progress flag
+        if (i+1)%10==0:
+            print(f'Done with {i+1} out of {len(tasks)} avi files')
+
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+
+    return(missing)
@@ -3,6 +3,10 @@
 #
 # (c) 2019 Jean-Olivier Irisson, GNU General Public License v3
 
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import cv2
 import skimage.measure
@@ -11,25 +15,31 @@ import apeep.timers as t
 
 # from ipdb import set_trace as db
 
-def read(path):
+def read(path, compact=False):
     """
     Read a greyscale image into a numpy array
     
     Args:
         path (str): path to the image
+        compact (bool): keep the image as 8 bit integers, 8 times smaller than floats;
+            convert it to float only when needed (default is False)
     
     Returns:
-        ndarray: of float in [0,1]
+        ndarray: of float in [0,1], or of uint8 in [0,255] when compact
     """
     x = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if compact:
+        return(x)
     return(x / 255.)
 
-def read_mask(path):
+def read_mask(path, compact=False):
     """
     Read a mask image into a numpy array with labelled particles
     
     Args:
         path (str): path to the image
+        compact (bool): store labels in the smallest unsigned integer type which fits 
+            them, see compact_labels (default is False)
     
     Returns:
         ndarray: labelled mask
@@ -37,20 +47,74 @@ def read_mask(path):
     x = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
     x = x == 0
     x = skimage.measure.label(x)
+    if compact:
+        x = compact_labels(x)
     return(x)
 
+def compact_labels(x):
+    """
+    Convert a labelled mask to the smallest unsigned integer type which fits its labels
+    
+    skimage.measure.label returns 64 bit integers, while images rarely contain more than
+    65535 particles: masks are then 4 to 8 times smaller.
+    
+    Args:
+        x (ndarray): labelled mask, with non negative labels
+    
+    Returns:
+        ndarray: of uint8, uint16, uint32 or uint64, with the same labels
+    """
+    max_label = int(x.max()) if x.size > 0 else 0
+    return(x.astype(np.min_scalar_type(max_label), copy=False))
+
+def prefetch(paths, fun=read, depth=2):
+    """
+    Read images in advance, on background threads, while previous ones are processed
+    
+    Images are read `depth` at a time, with one thread each (decoding in openCV releases
+    the GIL), and returned in the order of `paths`. At most `depth` images are being read
+    or waiting to be used at any time, so that memory use is bounded.
+    
+    Args:
+        paths (iterable): paths to the images (or any argument of fun)
+        fun (function): function to read one image (default is read)
+        depth (int): number of images to read in advance (default is 2)
+    
+    Yields:
+        the result of fun for each path, in order
+    
+    Example:
+        for x in prefetch(paths, read_mask):
+            process(x)
+    """
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        # start reading the first images
+        pending = collections.deque(executor.submit(fun, p) for p in itertools.islice(paths, depth))
+        while pending:
+            # wait for the next image
+            x = pending.popleft().result()
+            # start reading another one to replace it
+            for p in itertools.islice(paths, 1):
+                pending.append(executor.submit(fun, p))
+            yield x
+    pass
+
 def asimg(x):
     """
     Convert numpy array into 8 bit image
     
     Args:
-        x (ndarray): numpy array of floats in [0,1].
+        x (ndarray): numpy array of floats in [0,1], or of uint8 in [0,255].
     
     Returns:
         ndarray: of uint8, in BGR order when the input is RGB.
     """
-    # convert to 8 bit
-    x_uint8 = (x * 255).astype(np.uint8)
+    # convert to 8 bit, unless it already is
+    if x.dtype == np.uint8:
+        x_uint8 = x
+    else:
+        x_uint8 = (x * 255).astype(np.uint8)
     # if it is an RGB image, put the channels in BGR order, as expected by openCV
     if len(x.shape)==3 :
         x_uint8 = x_uint8[:,:,[2,1,0]]
@@ -82,7 +146,7 @@ def _save(x, path):
     Save an array as an image
     
     Args:
-        x (ndarray): numpy array of floats in [0,1].
+        x (ndarray): numpy array of floats in [0,1], or of uint8 in [0,255].
     """
     cv2.imwrite(path, asimg(x))
     pass
@@ -0,0 +1,81 @@
+#
+# Manifest of input files, to only reprocess what changed
+#
+
+import os
+import json
+import hashlib
+
+def file_signature(path, method='mtime'):
+    """
+    Compute a signature of a file, which changes when the file changes
+
+    Args:
+        path (str): path to the file
+        method (str): 'mtime' to use the size and modification time of the file (fast),
+            'hash' to use the md5 checksum of its content (robust to copies and touches)
+            (default is 'mtime')
+
+    Returns:
+        (str) signature of the file, None if it does not exist
+    """
+    assert method in ('mtime', 'hash'), "`method` should be 'mtime' or 'hash'"
+
+    if not os.path.exists(path):
+        return(None)
+
+    if method == 'mtime':
+        st = os.stat(path)
+        sig = str(st.st_size) + '-' + str(st.st_mtime_ns)
+    else:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        sig = md5.hexdigest()
+
+    return(sig)
+
+def inputs_signature(paths, method='mtime'):
+    """
+    Compute the signatures of several input files
+
+    Args:
+        paths (list): paths to the files
+        method (str): see file_signature
+
+    Returns:
+        (dict) signature of each file, keyed by path
+    """
+    return({p: file_signature(p, method=method) for p in paths})
+
+def read(path):
+    """
+    Read a manifest
+
+    Args:
+        path (str): path to the manifest file (json)
+
+    Returns:
+        (dict) the manifest, empty if the file does not exist
+    """
+    if not os.path.exists(path):
+        return({})
+    with open(path, 'r') as f:
+        return(json.load(f))
+
+def write(manifest, path):
+    """
+    Write a manifest
+
+    The file is replaced atomically, so that an interrupted run never leaves a corrupted manifest.
+
+    Args:
+        manifest (dict): the manifest
+        path (str): path to the manifest file (json)
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+    pass
@@ -0,0 +1,305 @@
+#
+# Process manual stacks: extract and measure particles for Ecotaxa import, generate segmented images
+#
+
+import os
+import shutil
+import multiprocessing
+import traceback
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+import lib.im_opencv as im
+import lib.segment as segment
+import lib.measure as measure
+import lib.sink as sink
+
+def process_stack(psd_file, segmented_image_dir, particles_dir, sample_id, props, px2mm,
+                  min_area=50, alpha_threshold=100, psd_cache=False, orientation_step=8,
+                  id_scheme='md5', write_tar=True, write_threads=4):
+    """
+    Process one manual stack: write its segmented image, and its particles and their properties
+
+    Args:
+        psd_file (str): path to the corrected stack ('Sans titre.psd'); the original
+            stack ('frame.psd') is in the same directory
+        segmented_image_dir (str): directory to write the segmented image to
+        particles_dir (str): directory to write particles to, in a tar archive or a
+            directory named after the image
+        sample_id (str): sample_id to use for ecotaxa
+        props (list): properties to measure for each particle
+        px2mm (float): size of a pixel in mm
+        min_area (int): minimum size of particles, see segment.split_psd
+        alpha_threshold (int): alpha value above which to consider particles, see segment.split_psd
+        psd_cache (bool): cache decoded psd layers next to stacks, see segment.read_psd
+        orientation_step (int): compare one pixel every orientation_step rows and columns
+            to check whether the corrected stack is flipped, see segment.same_image
+        id_scheme (str): how to identify particles, see measure.particle_id
+        write_tar (bool): write particles and their properties in a tar archive (True)
+            or in a directory (False)
+        write_threads (int): number of threads to encode particles images with, in tar archives
+
+    Returns:
+        particles_props (dataframe): properties of particles, None when there are none
+    """
+    # Extract image name
+    img_name = psd_file.split('/')[-2]
+
+    # Extract back and mask from psd image
+    back, mask = segment.split_psd(psd_file, min_area = min_area, alpha_threshold = alpha_threshold, cache = psd_cache, compact = True)
+
+    # Extract back only from original psd image
+    back_orig, _ = segment.read_psd(psd_file.replace('Sans titre', 'frame'), cache = psd_cache, back_only = True)
+
+    # If back from original and corrected images are different, vertically flip both corrected back and mask
+    # NB: vertical flip because 'split_psd' function rotates back and mask of 90° counter clockwise
+    if not segment.same_image(back, back_orig, step = orientation_step):
+        back = np.flipud(back)
+        mask = np.flipud(mask)
+        print(f'Flipping image {img_name}')
+
+    # NB: back is kept as uint8: particles are extracted directly as uint8, and intensities
+    #     and md5 ids are the same as from the float32 background, see measure.measure
+
+    # NB: the mask is written last, once particles are written, so that only complete
+    #     stacks are found in the segmented images directory by the next steps
+    mask_file = os.path.join(segmented_image_dir, img_name + '.png')
+
+    # If no particles are found in psd image, write mask and stop there
+    if np.sum(mask) == 0:
+        im.save(mask == 0, mask_file)
+        return(None)
+
+    # Extract particles and their properties
+    particles, particles_props = measure.measure(
+        img = back,
+        img_labelled = mask,
+        img_name = img_name,
+        sample_id = sample_id,
+        props = props,
+        id_scheme = id_scheme
+    )
+
+    # Write particles and properties
+    particles_images_dir = os.path.join(particles_dir, img_name)
+    if write_tar:
+        # directly in a tar archive, ready for Ecotaxa import
+        measure.write_particles_tar(particles, particles_props, particles_images_dir + '.tar', px2mm=px2mm, n_threads=write_threads)
+    else:
+        os.makedirs(particles_images_dir, exist_ok=True)
+        # write particles images
+        measure.write_particles(particles, particles_images_dir, px2mm=px2mm)
+        # and properties
+        measure.write_particles_props(particles_props, particles_images_dir)
+
+    # Write mask
+    im.save(mask == 0, mask_file)
+
+    return(particles_props)
+
+def remove_outputs(img_name, segmented_image_dir, particles_dir):
+    """
+    Remove the segmented image and the particles of a stack which failed, whether partial
+    or left from a previous run, so that incomplete stacks are not used by the next steps.
+
+    Args:
+        img_name (str): name of the image
+        segmented_image_dir (str): directory of segmented images
+        particles_dir (str): directory of particles
+
+    Returns:
+        Nothing
+    """
+    for f in [os.path.join(segmented_image_dir, img_name + '.png'),
+              os.path.join(particles_dir, img_name + '.tar'),
+              os.path.join(particles_dir, img_name + '.tar.tmp')]:
+        if os.path.exists(f):
+            os.remove(f)
+    shutil.rmtree(os.path.join(particles_dir, img_name), ignore_errors=True)
+
+def build_import_zip(particles_dir, img_names, destination):
+    """
+    Gather the particles and properties of several images in a single zip archive for Ecotaxa import
+
+    Args:
+        particles_dir (str): directory where particles of each image were written, in a tar
+            archive or a directory named after the image
+        img_names (list): names of images to include
+        destination (str): path to the zip archive
+
+    Returns:
+        Nothing
+    """
+    # write to a temporary file, renamed when complete, to never leave partial archives
+    tmp = destination + '.tmp'
+    # NB: store files without compression, png images are already compressed
+    with zipfile.ZipFile(tmp, 'w', compression=zipfile.ZIP_STORED) as z:
+        for img_name in img_names:
+            tar_file = os.path.join(particles_dir, img_name + '.tar')
+            if os.path.exists(tar_file):
+                # copy members of the tar archive, which are already in a directory named after the image
+                with tarfile.open(tar_file, 'r') as tar:
+                    for member in tar.getmembers():
+                        if member.isfile():
+                            z.writestr(member.name, tar.extractfile(member).read())
+            else:
+                img_dir = os.path.join(particles_dir, img_name)
+                for f in sorted(os.listdir(img_dir)):
+                    z.write(os.path.join(img_dir, f), arcname=img_name + '/' + f)
+    os.replace(tmp, destination)
+    pass
+
+def _process_stack_safely(psd_file, args):
+    """
+    Process one manual stack, catching errors so that they do not stop other stacks
+
+    Returns:
+        psd_file (str): path to the stack
+        particles_props (dataframe): properties of particles, None when there are none or on error
+        error (str): traceback of the error, None when the stack was processed
+    """
+    try:
+        return(psd_file, process_stack(psd_file, **args), None)
+    except Exception:
+        return(psd_file, None, traceback.format_exc())
+
+# Arguments of process_stack in worker processes, set once per worker
+_worker_args = {}
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+    pass
+
+def _process_stack_worker(psd_file):
+    return(_process_stack_safely(psd_file, _worker_args))
+
+def _process_stacks_parallel(man_stacks, args, n_workers):
+    """
+    Process manual stacks with a pool of worker processes, yielding results in the order of stacks
+
+    A worker process may die while processing a stack (e.g. killed when out of memory, or
+    crashed in a compiled library), which no exception handler can catch: the pool then
+    breaks and all stacks in progress are lost. The first lost stack is then run again alone,
+    to find out whether it is the one which killed its worker (in which case it is recorded
+    as failed), and a new pool is started for the other lost stacks.
+
+    Args:
+        man_stacks (list): paths to corrected stacks
+        args (dict): arguments of process_stack
+        n_workers (int): number of worker processes
+
+    Yields:
+        (psd_file, particles_props, error) for each stack, see _process_stack_safely
+    """
+    # NB: use fork, like in the match scripts, so that the calling script is not re-run in workers
+    context = multiprocessing.get_context('fork')
+    def new_executor(n):
+        return(ProcessPoolExecutor(n, mp_context = context, initializer = _init_worker, initargs = (args,)))
+
+    executor = new_executor(n_workers)
+    futures = [executor.submit(_process_stack_worker, psd_file) for psd_file in man_stacks]
+    for i, psd_file in enumerate(man_stacks):
+        broken = False
+        try:
+            result = futures[i].result()
+        except BrokenProcessPool:
+            broken = True
+        except Exception:
+            result = (psd_file, None, traceback.format_exc())
+        # NB: restart workers outside of the exception handler, which would otherwise be
+        #     inherited by forked workers and chained to their own errors
+        if broken:
+            executor.shutdown()
+            # run this stack again alone, to know whether it killed its worker
+            alone = new_executor(1)
+            try:
+                result = alone.submit(_process_stack_worker, psd_file).result()
+            except Exception:
+                result = (psd_file, None, traceback.format_exc())
+            alone.shutdown()
+            # and restart the pool for the following stacks which were lost with it
+            executor = new_executor(n_workers)
+            for j in range(i+1, len(man_stacks)):
+                if isinstance(futures[j].exception(), BrokenProcessPool):
+                    futures[j] = executor.submit(_process_stack_worker, man_stacks[j])
+        yield result
+    executor.shutdown()
+    pass
+
+def run(man_stacks, segmented_image_dir, particles_dir, n_workers=1, all_props_format='tsv', import_zip=True, **args):
+    """
+    Process all manual stacks and build the Ecotaxa import
+
+    Stacks are processed independently, in parallel if requested, and a failure on one
+    stack does not stop the others. Writes, in particles_dir, the particles of each image,
+    the properties of all particles in a single table (ecotaxa_particles_all), a zip archive
+    with the particles of all images to import in Ecotaxa (ecotaxa_import.zip) and the list
+    of stacks which failed, with the error (failures.tsv).
+
+    Args:
+        man_stacks (list): paths to corrected stacks ('Sans titre.psd')
+        segmented_image_dir (str): directory to write segmented images to
+        particles_dir (str): directory to write particles to
+        n_workers (int): number of worker processes to process stacks (1 to process them sequentially)
+        all_props_format (str): format of the table of properties of all particles, 'tsv'
+            or 'parquet'; None to not write it
+        import_zip (bool): build the zip archive for Ecotaxa import
+        **args: other arguments of process_stack (sample_id, props, px2mm, etc.)
+
+    Returns:
+        Nothing
+    """
+    os.makedirs(segmented_image_dir, exist_ok=True)
+    os.makedirs(particles_dir, exist_ok=True)
+    args = dict(args, segmented_image_dir = segmented_image_dir, particles_dir = particles_dir)
+
+    # Table of properties of all particles, written as images are processed
+    if all_props_format is not None:
+        all_props = sink.EcotaxaSink(os.path.join(particles_dir, 'ecotaxa_particles_all'), format = all_props_format)
+
+    ## Process stacks, in parallel if requested
+    if n_workers > 1:
+        # NB: results are returned in the order of stacks, so the merged outputs are deterministic
+        results = _process_stacks_parallel(man_stacks, args, n_workers)
+    else:
+        results = (_process_stack_safely(psd_file, args) for psd_file in man_stacks)
+
+    done = []
+    failures = []
+    for i, (psd_file, particles_props, error) in enumerate(results):
+        img_name = psd_file.split('/')[-2]
+        if error is not None:
+            print(f'Failed image {img_name}')
+            print(error)
+            failures.append({'img_name': img_name, 'psd_file': psd_file, 'error': error.strip().split('\n')[-1]})
+            remove_outputs(img_name, segmented_image_dir, particles_dir)
+        elif particles_props is not None:
+            # add properties to the table of all particles
+            if all_props_format is not None:
+                all_props.write(particles_props)
+            done.append(img_name)
+            print(f'Done image {img_name}')
+
+        # Progress flag
+        if (i+1)%10==0:
+            print(f'Done with {i+1} out of {len(man_stacks)}')
+
+    if all_props_format is not None:
+        all_props.close()
+
+    ## Merge outputs
+    # zip archive to import all particles in Ecotaxa at once
+    if import_zip:
+        build_import_zip(particles_dir, done, os.path.join(particles_dir, 'ecotaxa_import.zip'))
+
+    # report of failed stacks
+    pd.DataFrame(failures, columns = ['img_name', 'psd_file', 'error']).to_csv(os.path.join(particles_dir, 'failures.tsv'), sep = '\t', index = False)
+    print(f'{len(done)} images with particles, {len(failures)} failed')
+
+    pass
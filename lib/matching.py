@@ -1,3 +1,5 @@
+import numpy as np
+
 def check_bbox_overlap(bb_a, bb_b):
     """
     Check if two bbox overlap or not.
@@ -81,3 +83,477 @@ def bbox_iou(bb_a, bb_b):
     
     return(iou)
 
+
+def bbox_overlap_matrix(bb_a, bb_b):
+    """
+    Check which bbox of two sets overlap, for all pairs at once.
+    Args:
+        bb_a (ndarray): (N,4) coordinates of 1st set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+        bb_b (ndarray): (M,4) coordinates of 2nd set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+            Same coordinates convention as in check_bbox_overlap
+
+    Returns:
+        ndarray: (N,M) of bool, TRUE where there is an intersection, as in check_bbox_overlap
+    """
+    bb_a = np.asarray(bb_a).reshape(-1, 4)
+    bb_b = np.asarray(bb_b).reshape(-1, 4)
+    
+    # Determine the coordinates of all bbox intersections by broadcasting rows of a against rows of b
+    bb_top    = np.maximum(bb_a[:, None, 0], bb_b[None, :, 0])
+    bb_left   = np.maximum(bb_a[:, None, 1], bb_b[None, :, 1])
+    bb_bottom = np.minimum(bb_a[:, None, 2], bb_b[None, :, 2])
+    bb_right  = np.minimum(bb_a[:, None, 3], bb_b[None, :, 3])
+    
+    inter = (bb_right >= bb_left) & (bb_bottom >= bb_top)
+    
+    return(inter)
+
+
+def bbox_iou_matrix(bb_a, bb_b):
+    """
+    Compute the intersection over union (iou) of all pairs of bbox from two sets.
+    Args:
+        bb_a (ndarray): (N,4) coordinates of 1st set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+        bb_b (ndarray): (M,4) coordinates of 2nd set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+            Same coordinates convention as in bbox_iou
+
+    Returns:
+        ndarray: (N,M) of bbox iou values, element [i,j] being bbox_iou(bb_a[i], bb_b[j])
+    """
+    bb_a = np.asarray(bb_a, dtype=float).reshape(-1, 4)
+    bb_b = np.asarray(bb_b, dtype=float).reshape(-1, 4)
+    
+    # Compute height and width of all intersections, negative values meaning no intersection
+    inter_h = np.minimum(bb_a[:, None, 2], bb_b[None, :, 2]) - np.maximum(bb_a[:, None, 0], bb_b[None, :, 0])
+    inter_w = np.minimum(bb_a[:, None, 3], bb_b[None, :, 3]) - np.maximum(bb_a[:, None, 1], bb_b[None, :, 1])
+    # Compute the intersection area, set to 0 when bbox do not intersect
+    area_inter = np.clip(inter_h, 0, None) * np.clip(inter_w, 0, None)
+    
+    # Compute area of all bbox
+    area_bb_a = (bb_a[:, 2] - bb_a[:, 0]) * (bb_a[:, 3] - bb_a[:, 1])
+    area_bb_b = (bb_b[:, 2] - bb_b[:, 0]) * (bb_b[:, 3] - bb_b[:, 1])
+    
+    # Compute the union area as the sum of bbox area minus the intersection area
+    area_union = area_bb_a[:, None] + area_bb_b[None, :] - area_inter
+    
+    # Compute value of iou, 0 where there is no intersection
+    iou = np.divide(area_inter, area_union, out=np.zeros_like(area_inter), where=area_inter > 0)
+    
+    return(iou)
+
+
+def bbox_overlap_pairs(bb_a, bb_b):
+    """
+    Find all pairs of overlapping bbox from two sets, without comparing all pairs.
+    
+    Bbox are indexed with a sort-and-sweep along one axis: the intervals [bb1, bb3]
+    (or [bb0, bb2]) of both sets are sorted, the pairs of overlapping intervals are
+    found by binary search and only those are checked along the other axis. The axis
+    giving the fewest candidate pairs is used, so that the cost grows with the number
+    of overlaps rather than with N*M.
+    Args:
+        bb_a (ndarray): (N,4) coordinates of 1st set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+        bb_b (ndarray): (M,4) coordinates of 2nd set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+            Same coordinates convention as in check_bbox_overlap
+
+    Returns:
+        idx_a (ndarray): indexes of bbox in bb_a, for each pair
+        idx_b (ndarray): indexes of bbox in bb_b, for each pair
+            Pairs are those for which check_bbox_overlap is TRUE, sorted by idx_a then idx_b
+    """
+    bb_a = np.asarray(bb_a).reshape(-1, 4)
+    bb_b = np.asarray(bb_b).reshape(-1, 4)
+    
+    # index intervals along rows (bb0 to bb2) and columns (bb1 to bb3)
+    sweeps = [_sweep_intervals(bb_a[:, d], bb_a[:, d+2], bb_b[:, d], bb_b[:, d+2]) for d in (0, 1)]
+    # sweep along the axis with the fewest overlapping intervals
+    d = int(np.argmin([sw['n_pairs'] for sw in sweeps]))
+    idx_a, idx_b = _expand_sweep(sweeps[d])
+    
+    # among candidates, keep pairs which also overlap along the other axis
+    o = 1 - d
+    keep = np.maximum(bb_a[idx_a, o], bb_b[idx_b, o]) <= np.minimum(bb_a[idx_a, o+2], bb_b[idx_b, o+2])
+    idx_a = idx_a[keep]
+    idx_b = idx_b[keep]
+    
+    # sort pairs as a double loop over a then b would
+    order = np.lexsort((idx_b, idx_a))
+    
+    return(idx_a[order], idx_b[order])
+
+def _sweep_intervals(start_a, end_a, start_b, end_b):
+    """
+    Locate overlapping intervals between two sets of intervals, in sorted order.
+    
+    Two intervals overlap iff the start of one of them lies within the other; so
+    overlapping pairs are made of b intervals starting in [start_a, end_a] and of
+    a intervals starting in (start_b, end_b], which are contiguous ranges once
+    intervals are sorted by start.
+    
+    Returns:
+        dict: the sort orders, the ranges in sorted order and the total number of pairs
+    """
+    order_a = np.argsort(start_a, kind='stable')
+    order_b = np.argsort(start_b, kind='stable')
+    sorted_start_a = start_a[order_a]
+    sorted_start_b = start_b[order_b]
+    
+    # b intervals starting within each a interval
+    lo_b = np.searchsorted(sorted_start_b, start_a, side='left')
+    hi_b = np.searchsorted(sorted_start_b, end_a, side='right')
+    # a intervals starting within each b interval (strictly after its start, to avoid duplicates)
+    lo_a = np.searchsorted(sorted_start_a, start_b, side='right')
+    hi_a = np.searchsorted(sorted_start_a, end_b, side='right')
+    
+    n_pairs = np.sum(np.maximum(hi_b - lo_b, 0)) + np.sum(np.maximum(hi_a - lo_a, 0))
+    
+    return({
+        'order_a': order_a, 'order_b': order_b,
+        'lo_b': lo_b, 'hi_b': hi_b, 'lo_a': lo_a, 'hi_a': hi_a,
+        'n_pairs': n_pairs
+    })
+
+def _expand_sweep(sw):
+    """
+    Expand the ranges found by _sweep_intervals into pairs of indexes (idx_a, idx_b).
+    """
+    # b intervals starting within a intervals
+    idx_a1, pos_b = _expand_ranges(sw['lo_b'], sw['hi_b'])
+    idx_b1 = sw['order_b'][pos_b]
+    # a intervals starting within b intervals
+    idx_b2, pos_a = _expand_ranges(sw['lo_a'], sw['hi_a'])
+    idx_a2 = sw['order_a'][pos_a]
+    
+    return(np.concatenate((idx_a1, idx_a2)), np.concatenate((idx_b1, idx_b2)))
+
+def _expand_ranges(lo, hi):
+    """
+    Expand ranges [lo[i], hi[i]) into a flat array of positions and the index i they come from.
+    """
+    counts = np.maximum(hi - lo, 0)
+    owner = np.repeat(np.arange(len(lo)), counts)
+    # position within each range = global position - position of the start of this range
+    starts = np.cumsum(counts) - counts
+    pos = np.arange(np.sum(counts)) - np.repeat(starts, counts) + np.repeat(lo, counts)
+    return(owner, pos)
+
+
+def bbox_iou_pairs(bb_a, bb_b, threshold=0):
+    """
+    Find pairs of bbox from two sets with an intersection over union (iou) above a threshold.
+    
+    Only pairs of intersecting bbox, found with bbox_overlap_pairs, are considered.
+    Args:
+        bb_a (ndarray): (N,4) coordinates of 1st set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+        bb_b (ndarray): (M,4) coordinates of 2nd set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+        threshold (float): iou value above which to keep a pair (default is 0, i.e. all intersecting pairs)
+
+    Returns:
+        idx_a (ndarray): indexes of bbox in bb_a, for each pair
+        idx_b (ndarray): indexes of bbox in bb_b, for each pair
+        iou (ndarray): bbox iou value, for each pair
+            Pairs are sorted by idx_a then idx_b
+    """
+    bb_a = np.asarray(bb_a, dtype=float).reshape(-1, 4)
+    bb_b = np.asarray(bb_b, dtype=float).reshape(-1, 4)
+    
+    # get candidate pairs, with intersecting bbox
+    idx_a, idx_b = bbox_overlap_pairs(bb_a, bb_b)
+    
+    # compute iou of candidates only
+    iou = bbox_iou_rows(bb_a[idx_a], bb_b[idx_b])
+    keep = iou > threshold
+    
+    return(idx_a[keep], idx_b[keep], iou[keep])
+
+def bbox_iou_rows(bb_a, bb_b):
+    """
+    Compute the intersection over union (iou) of bbox taken row by row in two sets of same size.
+    Args:
+        bb_a (ndarray): (N,4) coordinates of 1st set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+        bb_b (ndarray): (N,4) coordinates of 2nd set of bbox, one row per bbox as [bb0, bb1, bb2, bb3]
+
+    Returns:
+        ndarray: (N,) of bbox iou values, element [i] being bbox_iou(bb_a[i], bb_b[i])
+    """
+    bb_a = np.asarray(bb_a, dtype=float).reshape(-1, 4)
+    bb_b = np.asarray(bb_b, dtype=float).reshape(-1, 4)
+    
+    # Compute the intersection area, set to 0 when bbox do not intersect
+    inter_h = np.minimum(bb_a[:, 2], bb_b[:, 2]) - np.maximum(bb_a[:, 0], bb_b[:, 0])
+    inter_w = np.minimum(bb_a[:, 3], bb_b[:, 3]) - np.maximum(bb_a[:, 1], bb_b[:, 1])
+    area_inter = np.clip(inter_h, 0, None) * np.clip(inter_w, 0, None)
+    
+    # Compute the union area as the sum of bbox area minus the intersection area
+    area_bb_a = (bb_a[:, 2] - bb_a[:, 0]) * (bb_a[:, 3] - bb_a[:, 1])
+    area_bb_b = (bb_b[:, 2] - bb_b[:, 0]) * (bb_b[:, 3] - bb_b[:, 1])
+    area_union = area_bb_a + area_bb_b - area_inter
+    
+    # Compute value of iou, 0 where there is no intersection
+    iou = np.divide(area_inter, area_union, out=np.zeros_like(area_inter), where=area_inter > 0)
+    
+    return(iou)
+
+
+def label_overlaps(mask_a, mask_b):
+    """
+    Compute the number of overlapping pixels of all pairs of particles from two labelled masks, in one pass.
+    
+    Labels of both masks are combined into a single code per pixel and overlapping pairs
+    are counted with bincount (or unique, when labels are too large for a dense count),
+    so that the cost is proportional to the number of pixels, not to the number of pairs.
+    Args:
+        mask_a (ndarray): 1st labelled mask, 0 being the background
+        mask_b (ndarray): 2nd labelled mask, of same shape as mask_a, 0 being the background
+
+    Returns:
+        label_a (ndarray): labels of particles in mask_a, for each overlapping pair
+        label_b (ndarray): labels of particles in mask_b, for each overlapping pair
+        n_pixels (ndarray): number of overlapping pixels, for each pair
+            Pairs are sorted by label_a then label_b
+    """
+    assert mask_a.shape == mask_b.shape, "masks should have the same shape"
+    
+    # keep only pixels which are in a particle in both masks
+    a = np.asarray(mask_a).ravel()
+    b = np.asarray(mask_b).ravel()
+    both = (a > 0) & (b > 0)
+    a = a[both].astype(np.int64)
+    b = b[both].astype(np.int64)
+    
+    if a.size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return(empty, empty, empty)
+    
+    # combine the labels of each pixel into a single code
+    n_b = int(b.max()) + 1
+    code = a * n_b + b
+    
+    # count pixels per code
+    n_codes = int(a.max()) * n_b + n_b
+    if n_codes <= 4 * code.size + 1024:
+        # dense count when the table of codes is small enough
+        counts = np.bincount(code, minlength=n_codes)
+        code = np.flatnonzero(counts)
+        n_pixels = counts[code]
+    else:
+        # sparse count otherwise
+        code, n_pixels = np.unique(code, return_counts=True)
+    
+    # decode labels
+    label_a, label_b = np.divmod(code, n_b)
+    
+    return(label_a, label_b, n_pixels)
+
+
+def mask_iou_pairs(mask_a, mask_b, labels_a, area_a, labels_b, area_b):
+    """
+    Compute the mask intersection over union (iou) and Dice coefficient of all pairs of overlapping particles.
+    
+    Intersections come from a single pass over both masks (see label_overlaps) and unions
+    from the area of particles, as computed by measure.measure.
+    Args:
+        mask_a (ndarray): 1st labelled mask, 0 being the background
+        mask_b (ndarray): 2nd labelled mask, of same shape as mask_a, 0 being the background
+        labels_a (ndarray): labels of particles in mask_a
+        area_a (ndarray): area (in pixels) of particles in mask_a, in the same order as labels_a
+        labels_b (ndarray): labels of particles in mask_b
+        area_b (ndarray): area (in pixels) of particles in mask_b, in the same order as labels_b
+
+    Returns:
+        label_a (ndarray): labels of particles in mask_a, for each overlapping pair
+        label_b (ndarray): labels of particles in mask_b, for each overlapping pair
+        iou (ndarray): mask iou, for each pair
+        dice (ndarray): mask Dice coefficient, for each pair
+    """
+    # compute intersections
+    label_a, label_b, n_inter = label_overlaps(mask_a, mask_b)
+    
+    # get areas of particles in each pair
+    pair_area_a = _label_lookup(labels_a, area_a, label_a)
+    pair_area_b = _label_lookup(labels_b, area_b, label_b)
+    
+    # compute iou and dice
+    iou = n_inter / (pair_area_a + pair_area_b - n_inter)
+    dice = 2 * n_inter / (pair_area_a + pair_area_b)
+    
+    return(label_a, label_b, iou, dice)
+
+def match_particles(bb_a, bb_b, mask_a, mask_b, labels_a, area_a, labels_b, area_b, match_on='bbox_iou', threshold=0.1):
+    """
+    Match particles from two sets and report bbox iou, mask iou and mask Dice coefficient of matches.
+    Args:
+        bb_a (ndarray): (N,4) bbox of particles in 1st set, one row per particle as [bb0, bb1, bb2, bb3]
+        bb_b (ndarray): (M,4) bbox of particles in 2nd set, one row per particle as [bb0, bb1, bb2, bb3]
+        mask_a (ndarray): labelled mask of particles in 1st set
+        mask_b (ndarray): labelled mask of particles in 2nd set
+        labels_a (ndarray): (N,) labels of particles in 1st set, in mask_a; expected to be unique
+        area_a (ndarray): (N,) area of particles in 1st set
+        labels_b (ndarray): (M,) labels of particles in 2nd set, in mask_b; expected to be unique
+        area_b (ndarray): (M,) area of particles in 2nd set
+        match_on (str): value on which to match particles: 'bbox_iou', 'mask_iou' or 'mask_dice'
+            (default is 'bbox_iou')
+        threshold (float): value above which particles are matched (default is 0.1)
+
+    Returns:
+        dict: of ndarrays, with one element per match:
+            idx_a and idx_b: indexes of matched particles in 1st and 2nd set
+            bbox_iou, mask_iou and mask_dice: matching values of the pair, 0 when masks do not overlap
+            Matches are sorted by idx_a then idx_b
+    """
+    assert match_on in ('bbox_iou', 'mask_iou', 'mask_dice'), \
+        "`match_on` should be 'bbox_iou', 'mask_iou' or 'mask_dice'"
+    bb_a = np.asarray(bb_a, dtype=float).reshape(-1, 4)
+    bb_b = np.asarray(bb_b, dtype=float).reshape(-1, 4)
+    labels_a = np.asarray(labels_a)
+    labels_b = np.asarray(labels_b)
+    
+    # compute mask iou and dice for all pairs with overlapping masks
+    ov_label_a, ov_label_b, ov_iou, ov_dice = mask_iou_pairs(mask_a, mask_b, labels_a, area_a, labels_b, area_b)
+    
+    if match_on == 'bbox_iou':
+        # match on bbox
+        idx_a, idx_b, bbox_iou = bbox_iou_pairs(bb_a, bb_b, threshold=threshold)
+        # and look up mask values of matched pairs
+        mask_iou  = _pair_lookup(ov_label_a, ov_label_b, ov_iou,  labels_a[idx_a], labels_b[idx_b])
+        mask_dice = _pair_lookup(ov_label_a, ov_label_b, ov_dice, labels_a[idx_a], labels_b[idx_b])
+    
+    else:
+        # match on mask
+        keep = (ov_iou if match_on == 'mask_iou' else ov_dice) > threshold
+        mask_iou  = ov_iou[keep]
+        mask_dice = ov_dice[keep]
+        # convert labels to indexes of particles, dropping particles which are not in the sets
+        idx_a = _label_lookup(labels_a, np.arange(len(labels_a)), ov_label_a[keep], default=-1)
+        idx_b = _label_lookup(labels_b, np.arange(len(labels_b)), ov_label_b[keep], default=-1)
+        known = (idx_a >= 0) & (idx_b >= 0)
+        order = np.lexsort((idx_b[known], idx_a[known]))
+        idx_a = idx_a[known][order]
+        idx_b = idx_b[known][order]
+        mask_iou  = mask_iou[known][order]
+        mask_dice = mask_dice[known][order]
+        # and compute bbox iou of matched pairs
+        bbox_iou = bbox_iou_rows(bb_a[idx_a], bb_b[idx_b])
+    
+    return({
+        'idx_a': idx_a,
+        'idx_b': idx_b,
+        'bbox_iou': bbox_iou,
+        'mask_iou': mask_iou,
+        'mask_dice': mask_dice
+    })
+
+def _label_lookup(labels, values, query, default=0):
+    """
+    Get the values associated to some labels, through a lookup table indexed by label.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    query = np.asarray(query, dtype=np.int64)
+    n = max(labels.max(initial=0), query.max(initial=0)) + 1
+    lut = np.full(n, default, dtype=np.asarray(values).dtype)
+    lut[labels] = values
+    return(lut[query])
+
+def _pair_lookup(label_a, label_b, values, query_a, query_b, default=0):
+    """
+    Get the values associated to pairs of labels (query_a, query_b) from a sparse table of
+    pairs (label_a, label_b) sorted by label_a then label_b.
+    """
+    query_a = np.asarray(query_a, dtype=np.int64)
+    query_b = np.asarray(query_b, dtype=np.int64)
+    # encode pairs as single codes, which keep the sort order of the table
+    n_b = max(np.max(label_b, initial=0), np.max(query_b, initial=0)) + 1
+    codes = np.asarray(label_a, dtype=np.int64) * n_b + label_b
+    query = query_a * n_b + query_b
+    out = np.full(len(query), default, dtype=float)
+    if len(codes) == 0:
+        return(out)
+    # find queries in the table
+    pos = np.minimum(np.searchsorted(codes, query), len(codes) - 1)
+    found = codes[pos] == query
+    out[found] = np.asarray(values)[pos[found]]
+    return(out)
+
+
+def assign_one_to_one(idx_a, idx_b, score):
+    """
+    Select a one-to-one assignment among candidate pairs of particles, greedily by decreasing score.
+    
+    Candidate pairs are considered from the best to the worst score and a pair is kept
+    when neither of its particles has already been assigned. Only the sparse set of
+    candidates is used, never a dense N*M matrix.
+    Args:
+        idx_a (ndarray): indexes of particles in 1st set, for each candidate pair
+        idx_b (ndarray): indexes of particles in 2nd set, for each candidate pair
+        score (ndarray): matching value (e.g. iou) of each candidate pair, the higher the better
+
+    Returns:
+        ndarray: of bool, TRUE for the candidate pairs which are part of the assignment
+    """
+    idx_a = np.asarray(idx_a)
+    idx_b = np.asarray(idx_b)
+    # sort candidates by decreasing score; ties are kept in their original order
+    order = np.argsort(-np.asarray(score, dtype=float), kind='stable')
+    
+    assigned = np.zeros(len(order), dtype=bool)
+    used_a = set()
+    used_b = set()
+    for k in order:
+        a = idx_a[k]
+        b = idx_b[k]
+        if a not in used_a and b not in used_b:
+            assigned[k] = True
+            used_a.add(a)
+            used_b.add(b)
+    
+    return(assigned)
+
+
+def precision_recall_sweep(ids_a, ids_b, score, n_a, n_b, thresholds):
+    """
+    Compute precision and recall of matches for several thresholds, from a single set of candidate pairs.
+    
+    A particle is matched at threshold t when at least one of its candidate pairs has a
+    score > t, so matched counts for all thresholds come from the best score of each
+    particle, without matching again.
+    Args:
+        ids_a (ndarray): ids of reference (e.g. manual) particles, for each candidate pair
+        ids_b (ndarray): ids of predicted (e.g. automatic) particles, for each candidate pair
+        score (ndarray): matching value (e.g. iou) of each candidate pair
+        n_a (int): total number of reference particles
+        n_b (int): total number of predicted particles
+        thresholds (list): threshold values to compute precision and recall for
+
+    Returns:
+        dict: of ndarrays, with one element per threshold:
+            threshold, n_matches (number of pairs above threshold),
+            n_matched_a and n_matched_b (number of matched particles in each set),
+            precision (n_matched_b / n_b) and recall (n_matched_a / n_a)
+    """
+    score = np.asarray(score, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float)
+    
+    def n_above(x):
+        # number of values strictly above each threshold
+        x = np.sort(x)
+        return(len(x) - np.searchsorted(x, thresholds, side='right'))
+    
+    def best_score(ids):
+        # best score of each particle among its candidate pairs
+        _, inv = np.unique(np.asarray(ids), return_inverse=True)
+        best = np.full(inv.max(initial=-1) + 1, -np.inf)
+        np.maximum.at(best, inv.ravel(), score)
+        return(best)
+    
+    n_matches = n_above(score)
+    n_matched_a = n_above(best_score(ids_a))
+    n_matched_b = n_above(best_score(ids_b))
+    
+    return({
+        'threshold': thresholds,
+        'n_matches': n_matches,
+        'n_matched_a': n_matched_a,
+        'n_matched_b': n_matched_b,
+        'precision': n_matched_b / n_b if n_b > 0 else np.full(len(thresholds), np.nan),
+        'recall': n_matched_a / n_a if n_a > 0 else np.full(len(thresholds), np.nan)
+    })
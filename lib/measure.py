@@ -1,4 +1,8 @@
 import os
+import io
+import time
+import tarfile
+import functools
 
 from psd_tools import PSDImage
 import skimage.measure
@@ -6,24 +10,28 @@ import numpy as np
 import hashlib
 import pandas as pd
 import cv2
+import scipy.ndimage
 
 import lib.im_opencv as im
+import lib.sink as sink
 
-def measure(img, img_labelled, img_name, sample_id, props=['label', 'area']):
+def measure(img, img_labelled, img_name, sample_id, props=['label', 'area'], id_scheme='md5'):
     """
     Measure particles
     
     Args:
-        img (ndarray): image (of type float)
+        img (ndarray): image (of type float, or uint8 as read by im.read(compact=True);
+            intensities are then measured in [0,1], see regions_props)
         img_labelled (ndarray): labelled image (mask with each particle 
             numbered as an integer)
         img_name (str): name of image
         sample_id (str): sample_id to use for ecotaxa
         properties (list): list of properties to extract from each particle
+        id_scheme (str): how to identify particles, see particle_id (default is 'md5')
     
     Returns:
-        particles (dict): dict of ndarrays containing particles; the keys are
-            their md5 checksum
+        particles (dict): dict of ndarrays containing particles (of uint8 when img
+            is, see get_particle_array); the keys are their id
         partitles_props (dataframe): dataframe containing their
             properties, suitable to be turned into a pandas DataFrame
     """
@@ -33,25 +41,318 @@ def measure(img, img_labelled, img_name, sample_id, props=['label', 'area']):
     
     # extract the content of the particles
     particles = [get_particle_array(r) for r in regions]
-    # uniquement identify particles with their md5 checksum
-    particles = {hashlib.md5(p).hexdigest():p for p in particles}
+    # uniquement identify particles with a checksum
+    particles = {particle_id(r, p, scheme=id_scheme):p for r,p in zip(regions, particles)}
 
     # store this as their first property
     particle_props = {'id': list(particles.keys())}    
     # append the other properties we need
-    # NB: append so that the md5 column is the first one
-    particle_props.update(skimage.measure._regionprops._props_to_dict(regions, properties=props))
+    # NB: append so that the id column is the first one
+    particle_props.update(regions_props(img, img_labelled, properties=props, regions=regions))
 
+    # add date, time and sample information and format for ecotaxa
+    particle_props = format_props(particle_props, img_name, sample_id)
+
+    return (particles, particle_props)
+
+def measure_props(img_labelled, img_name, sample_id, stats=None):
+    """
+    Measure label, bbox and area of particles, without extracting them
+    
+    Lightweight alternative to measure() when only the position and size of particles
+    are needed (e.g. for matching): bbox come from scipy.ndimage.find_objects and areas
+    from a single bincount, without copying the pixels of particles or needing the
+    intensity image.
+    
+    Args:
+        img_labelled (ndarray): labelled image (mask with each particle 
+            numbered as an integer)
+        img_name (str): name of image
+        sample_id (str): sample_id to use for ecotaxa
+        stats (dict): label, bbox and area of particles, as returned by label_stats;
+            computed from img_labelled when None (e.g. read from a cache otherwise)
+    
+    Returns:
+        particle_props (dataframe): dataframe with the same columns as the one
+            from measure() with props=['label', 'bbox', 'area']; particles are
+            identified by the md5 checksum of the image name, their label and bbox
+    """
+    # compute bbox and area of each label, unless they are given
+    if stats is None:
+        stats = label_stats(img_labelled)
+    labels = stats['label']
+    bbox = stats['bbox']
+    area = stats['area']
+    
+    # identify particles uniquely from their position in the image
+    # NB: as an array of str even when empty, so that empty tables can be formatted too
+    ids = [hashlib.md5(f'{img_name}_{l}_{b[0]}_{b[1]}_{b[2]}_{b[3]}'.encode()).hexdigest() for l,b in zip(labels, bbox)]
+    ids = np.array(ids, dtype=object)
+    
+    particle_props = {
+        'id': ids,
+        'label': labels,
+        'bbox-0': bbox[:,0],
+        'bbox-1': bbox[:,1],
+        'bbox-2': bbox[:,2],
+        'bbox-3': bbox[:,3],
+        'area': area
+    }
+    
+    # add date, time and sample information and format for ecotaxa
+    particle_props = format_props(particle_props, img_name, sample_id)
+    
+    return(particle_props)
+
+def label_stats(img_labelled):
+    """
+    Compute label, bbox and area of all particles of a labelled image
+    
+    Args:
+        img_labelled (ndarray): labelled image (mask with each particle 
+            numbered as an integer)
+    
+    Returns:
+        dict: with 'label' (n), 'bbox' (n,4: min_row, min_col, max_row, max_col, 
+            as in regionprops) and 'area' (n) arrays of int, in increasing label order
+    """
+    # find the bbox of each label, as the slices enclosing it
+    slices = scipy.ndimage.find_objects(img_labelled)
+    labels = np.array([i+1 for i,sl in enumerate(slices) if sl is not None], dtype=int)
+    bbox = np.array([[sl[0].start, sl[1].start, sl[0].stop, sl[1].stop] for sl in slices if sl is not None], dtype=int).reshape(-1, 4)
+    
+    # count pixels of each label
+    area = np.bincount(img_labelled.ravel(), minlength=len(slices)+1)[labels]
+    
+    return({'label': labels, 'bbox': bbox, 'area': area})
+
+# Properties computed for all regions at once by regions_props, with the shape of their value for each region
+VECTORIZED_PROPS = {
+    'label': (),
+    'area': (),
+    'num_pixels': (),
+    'bbox': (4,),
+    'area_bbox': (),
+    'extent': (),
+    'equivalent_diameter_area': (),
+    'centroid': (2,),
+    'centroid_local': (2,),
+    'moments': (4,4),
+    'moments_central': (4,4),
+    'moments_normalized': (4,4),
+    'moments_hu': (7,),
+    'inertia_tensor': (2,2),
+    'inertia_tensor_eigvals': (2,),
+    'axis_major_length': (),
+    'axis_minor_length': (),
+    'eccentricity': (),
+    'orientation': (),
+    'intensity_mean': (),
+    'intensity_std': (),
+    'intensity_min': (),
+    'intensity_max': (),
+}
+
+# Prefixes of the names of properties which depend on the intensity image
+INTENSITY_PREFIXES = ('intensity_', 'image_intensity', 'centroid_weighted', 'moments_weighted')
+
+def regions_props(img, img_labelled, properties=['label', 'area'], regions=None):
+    """
+    Measure properties of all particles of a labelled image at once
+    
+    Drop-in replacement for skimage.measure._regionprops._props_to_dict: properties in
+    VECTORIZED_PROPS are computed for all particles in a single pass over their pixels,
+    with bincount-style reductions, instead of one particle at a time in Python. Other
+    properties (e.g. perimeter, solidity) are still computed by regionprops.
+    Properties are equal to those of regionprops, up to floating point rounding for
+    centroids, moments, intensity means and standard deviations (summed in a different order).
+    The orientation is computed with the same formula and conventions as regionprops, but
+    with this rounding, it can be pi/2 instead of -pi/2 (or the reverse) for particles which
+    major axis is nearly along the columns and whose mixed central moment mu11 is then ~0
+    (e.g. nearly round particles): both describe the same axis.
+    
+    Args:
+        img (ndarray): 2D image, in which to measure intensity properties; when of uint8,
+            intensities are measured in [0,1], as on the float32 image x/255
+        img_labelled (ndarray): labelled image (mask with each particle 
+            numbered as an integer)
+        properties (list): names of properties to measure, as in regionprops 
+            (including deprecated names, such as 'convex_area')
+        regions (list): RegionProperties of img_labelled, from skimage.measure.regionprops,
+            to compute other properties with; created when needed if None
+    
+    Returns:
+        dict: of arrays with one value per particle, in increasing label order; 
+            columns are named as by _props_to_dict (e.g. 'bbox-0', 'moments_hu-3')
+    """
+    # current names and types of properties
+    names = {p: skimage.measure._regionprops.PROPS.get(p, p) for p in properties}
+    dtypes = skimage.measure._regionprops.COL_DTYPES
+    
+    # properties which are not vectorized, or do not have the expected shape, are computed by regionprops
+    other_props = [p for p in properties if names[p] not in VECTORIZED_PROPS or \
+        (names[p].startswith('intensity_') and (img is None or img.ndim != 2))]
+    if len(other_props) > 0:
+        if img is not None and img.dtype == np.uint8 and \
+            any(names[p].startswith(INTENSITY_PREFIXES) for p in other_props):
+            # NB: regionprops measures the image as is, convert it to measure intensities in [0,1]
+            regions = skimage.measure.regionprops(label_image=img_labelled, intensity_image=img.astype(np.float32) / 255)
+        elif regions is None:
+            regions = skimage.measure.regionprops(label_image=img_labelled, intensity_image=img)
+        other_values = skimage.measure._regionprops._props_to_dict(regions, properties=other_props)
+    
+    ## Basic properties
+    # label, bbox and number of pixels
+    stats = label_stats(img_labelled)
+    n = len(stats['label'])
+    values = {
+        'label': stats['label'],
+        'bbox': stats['bbox'],
+        'num_pixels': stats['area'],
+        'area': stats['area'].astype(float),
+    }
+    values['area_bbox'] = ((stats['bbox'][:,2] - stats['bbox'][:,0]) * (stats['bbox'][:,3] - stats['bbox'][:,1])).astype(float)
+    values['extent'] = values['area'] / values['area_bbox']
+    values['equivalent_diameter_area'] = (4 * values['area'] / np.pi) ** (1 / 2)
+    
+    ## Pixels of all particles
+    needed = set(names.values())
+    if needed - set(values):
+        # coordinates of pixels in particles
+        rows, cols = np.nonzero(img_labelled)
+        # index of the particle of each pixel
+        lut = np.zeros(int(stats['label'].max(initial=0)) + 1, dtype=np.int64)
+        lut[stats['label']] = np.arange(n)
+        idx = lut[img_labelled[rows, cols]]
+        # coordinates relative to the bbox of the particle
+        r = (rows - stats['bbox'][idx,0]).astype(float)
+        c = (cols - stats['bbox'][idx,1]).astype(float)
+    
+    ## Moments
+    if needed & {'moments', 'centroid', 'centroid_local', 'moments_central', 'moments_normalized', 'moments_hu', 'inertia_tensor', 'inertia_tensor_eigvals', 'axis_major_length', 'axis_minor_length', 'eccentricity', 'orientation'}:
+        # raw moments, in the coordinates of the bbox
+        M = np.zeros((n, 4, 4))
+        for i in range(4):
+            for j in range(4):
+                M[:,i,j] = np.bincount(idx, weights=r**i * c**j, minlength=n)
+        values['moments'] = M
+        values['centroid_local'] = np.stack([M[:,1,0] / M[:,0,0], M[:,0,1] / M[:,0,0]], axis=1)
+        values['centroid'] = values['centroid_local'] + stats['bbox'][:,0:2]
+        
+        # central moments, around the centroid of each particle
+        # NB: compute them from the pixels rather than from raw moments, which is less accurate
+        dr = r - values['centroid_local'][idx,0]
+        dc = c - values['centroid_local'][idx,1]
+        mu = np.zeros((n, 4, 4))
+        for i in range(4):
+            for j in range(4):
+                mu[:,i,j] = np.bincount(idx, weights=dr**i * dc**j, minlength=n)
+        values['moments_central'] = mu
+        
+        # normalized moments, only defined for orders >= 2
+        nu = np.full((n, 4, 4), np.nan)
+        for i in range(4):
+            for j in range(4):
+                if i + j >= 2:
+                    nu[:,i,j] = mu[:,i,j] / mu[:,0,0] ** ((i + j) / 2 + 1)
+        values['moments_normalized'] = nu
+        
+        # Hu moments, from normalized moments
+        t0 = nu[:,3,0] + nu[:,1,2]
+        t1 = nu[:,2,1] + nu[:,0,3]
+        q0 = t0 * t0
+        q1 = t1 * t1
+        n4 = 4 * nu[:,1,1]
+        s = nu[:,2,0] + nu[:,0,2]
+        d = nu[:,2,0] - nu[:,0,2]
+        hu = np.zeros((n, 7))
+        hu[:,0] = s
+        hu[:,1] = d * d + n4 * nu[:,1,1]
+        hu[:,3] = q0 + q1
+        hu[:,5] = d * (q0 - q1) + n4 * t0 * t1
+        t0 = t0 * (q0 - 3 * q1)
+        t1 = t1 * (3 * q0 - q1)
+        q0 = nu[:,3,0] - 3 * nu[:,1,2]
+        q1 = 3 * nu[:,2,1] - nu[:,0,3]
+        hu[:,2] = q0 * q0 + q1 * q1
+        hu[:,4] = q0 * t0 + q1 * t1
+        hu[:,6] = q1 * t0 - q0 * t1
+        values['moments_hu'] = hu
+        
+        # inertia tensor and its eigen values, sorted decreasingly
+        T = np.zeros((n, 2, 2))
+        T[:,0,0] = mu[:,0,2] / mu[:,0,0]
+        T[:,1,1] = mu[:,2,0] / mu[:,0,0]
+        T[:,0,1] = T[:,1,0] = -mu[:,1,1] / mu[:,0,0]
+        values['inertia_tensor'] = T
+        ev = np.clip(np.linalg.eigvalsh(T), 0, None)[:,::-1]
+        values['inertia_tensor_eigvals'] = ev
+        
+        # shape descriptors derived from the inertia tensor
+        values['axis_major_length'] = 4 * np.sqrt(ev[:,0])
+        values['axis_minor_length'] = 4 * np.sqrt(ev[:,1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values['eccentricity'] = np.where(ev[:,0] == 0, 0, np.sqrt(1 - ev[:,1] / ev[:,0]))
+        a = T[:,0,0]
+        b = T[:,0,1]
+        c = T[:,1,1]
+        values['orientation'] = np.where(a - c == 0, np.where(b < 0, np.pi / 4, -np.pi / 4), 0.5 * np.arctan2(-2 * b, c - a))
+    
+    ## Intensity
+    if needed & {'intensity_mean', 'intensity_std', 'intensity_min', 'intensity_max'} and img is not None and img.ndim == 2:
+        v = img[rows, cols]
+        if v.dtype == np.uint8:
+            # measure intensities in [0,1], identical to those of the float32 image x/255
+            v = v.astype(np.float32) / 255
+        v = v.astype(float)
+        values['intensity_mean'] = np.bincount(idx, weights=v, minlength=n) / stats['area']
+        values['intensity_std'] = np.sqrt(np.bincount(idx, weights=(v - values['intensity_mean'][idx])**2, minlength=n) / stats['area'])
+        # sort pixels by particle to reduce each particle at once
+        order = np.argsort(idx, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(stats['area'])[:-1]])
+        values['intensity_min'] = np.minimum.reduceat(v[order], starts) if n > 0 else np.zeros(0)
+        values['intensity_max'] = np.maximum.reduceat(v[order], starts) if n > 0 else np.zeros(0)
+    
+    ## Format as columns, in the order of properties
+    out = {}
+    for p in properties:
+        if p in other_props:
+            # copy columns computed by regionprops
+            for k in [k for k in other_values if k == p or k.startswith(p + '-')]:
+                out[k] = other_values[k]
+            continue
+        x = values[names[p]]
+        dtype = dtypes.get(names[p], float)
+        if x.ndim == 1:
+            out[p] = x.astype(dtype)
+        else:
+            # split arrays in one column per element
+            for ind in np.ndindex(x.shape[1:]):
+                out['-'.join(map(str, (p,) + ind))] = x[(slice(None),) + ind].astype(dtype)
+    
+    return(out)
+
+def format_props(particle_props, img_name, sample_id):
+    """
+    Format particles properties for ecotaxa
+    
+    Args:
+        particle_props (dict): properties of particles, the first one being their 'id'
+        img_name (str): name of image, formatted as a date time
+        sample_id (str): sample_id to use for ecotaxa
+    
+    Returns:
+        particle_props (dataframe): properties with ecotaxa column names, along with
+            date, time, acquisition, process and sample information
+    """
     # convert to dataframe
     particle_props = pd.DataFrame(particle_props)
     
     # add date and time information for particles
-    particle_props["date_time"] = pd.to_datetime(img_name, format="%Y-%m-%d_%H-%M-%S_%f") 
-    particle_props["time"] = pd.to_datetime(particle_props.date_time, format="%Y-%m-%d_%H-%M-%S_%f").dt.strftime('%H%M%S')
-    particle_props["date"] = pd.to_datetime(particle_props.date_time, format="%Y-%m-%d_%H-%M-%S_%f").dt.strftime('%Y%m%d')
-    
-    # remove datetime column
-    particle_props = particle_props.drop("date_time", axis=1)
+    # NB: parse it once, all particles come from the same image
+    date_time = pd.to_datetime(img_name, format="%Y-%m-%d_%H-%M-%S_%f") 
+    particle_props["time"] = date_time.strftime('%H%M%S')
+    particle_props["date"] = date_time.strftime('%Y%m%d')
     
     # add "object_" to column names 
     particle_props.columns = "object_" + particle_props.columns
@@ -81,21 +382,86 @@ def measure(img, img_labelled, img_name, sample_id, props=['label', 'area']):
     ]
     new_columns = cols_to_order + (particle_props.drop(cols_to_order, axis = 1).columns.tolist())
     particle_props = particle_props[new_columns]
+    
+    return(particle_props)
 
-    return (particles, particle_props)
+def particle_id(x, particle, scheme='md5'):
+    """
+    Compute the id of a particle, as a checksum of its content
+    
+    Args:
+        x (RegionProperties): from skimage.measure.region_props
+        particle (ndarray): particle extracted by get_particle_array
+        scheme (str): 'md5' for the md5 checksum of the float particle, as in apeep 
+            (legacy, slow for large particles and sensitive to floating point details);
+            'blake2b' or 'xxhash' (requires the xxhash package) for a short checksum of 
+            the 8 bits pixels of the particle, its shape and its bbox, which is faster
+            and does not depend on the type of the image (default is 'md5')
+    
+    Returns:
+        (str) hexadecimal id
+    """
+    assert scheme in ('md5', 'blake2b', 'xxhash'), "`scheme` should be 'md5', 'blake2b' or 'xxhash'"
+    
+    if scheme == 'md5':
+        # NB: the checksum is the one of the float particle, even when extracted as uint8
+        #     (as float32, like backgrounds read by psd_tools, see get_particle_array)
+        if particle.dtype == np.uint8:
+            particle = get_particle_array(x, as_float=True)
+        return(hashlib.md5(particle).hexdigest())
+    
+    if scheme == 'blake2b':
+        h = hashlib.blake2b(digest_size=8)
+    else:
+        # import here so that xxhash is only needed when this scheme is used
+        import xxhash
+        h = xxhash.xxh3_64()
+    # hash the position, the shape and the 8 bits content of the particle
+    # NB: the content is converted like when written to disk, so the id is the same from a float or uint8 image
+    h.update(np.asarray(x.bbox, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(x.image).tobytes())
+    crop = x._intensity_image[x._slice]
+    if crop.dtype != np.uint8:
+        crop = (crop * 255).astype(np.uint8)
+    h.update(np.ascontiguousarray(crop).tobytes())
+    return(h.hexdigest())
 
-def get_particle_array(x):
+# Values of uint8 pixels inside particles, identical to those of float particles once converted to 8 bits
+# (i.e. x/255 * 0.997 * 255, truncated, which is x-1 for x>0)
+DARKEN_LUT = (((np.arange(256) / 255.) * 0.997) * 255).astype(np.uint8)
+
+def get_particle_array(x, as_float=False):
     """
     Extract the particle pixels and blank out the outside
     
+    When the image is of uint8, the particle is extracted directly as uint8, with
+    the same values as the float particle converted to 8 bits by im.asimg: it is
+    written identically but without any float copy.
+    
     Args:
         x (RegionProperties): from skimage.measure.region_props
+        as_float (bool): always extract particles as floats (default is False)
     
     Returns:
-        (ndarray) of floats containing the particle values
+        (ndarray) of floats containing the particle values (of float32 when the image
+            is of uint8), or of uint8 when the image is of uint8
     """
     # extract the particle region
-    particle = x._intensity_image[x._slice] * 0.997
+    # NB: a view into the image, the particle is only copied once below
+    particle = x._intensity_image[x._slice]
+    if particle.dtype == np.uint8 and not as_float:
+        # convert values with a lookup table, into a new array
+        particle = DARKEN_LUT[particle]
+        # mask the outside of the particle with white, in place
+        particle[x._label_image[x._slice] != x.label] = 255
+        return(particle)
+    
+    # convert it to float when the image is compact
+    # NB: only the region of the particle, never the whole image; as float32, like
+    #     backgrounds read by psd_tools, so that md5 ids are the same from both images
+    if particle.dtype == np.uint8:
+        particle = particle.astype(np.float32) / 255
+    particle = particle * 0.997
     # mask the outside of the particle with white
     particle = np.where(x._label_image[x._slice] == x.label, particle, 1.)
     return(particle)
@@ -123,40 +489,8 @@ def write_particles_props(particles_props, destination):
     particles_file = os.path.join(destination, "ecotaxa_particles_" + sub_dir + ".tsv")
     # if file does't exist, create file with appropriate first row
     if not os.path.exists(particles_file):
-        
-        # add first row, containing data format codes; [f] for floats, [t] for text
-        # initiate first_row as floats
-        first_row = ['[f]'] * (particles_props.shape[1])
-
-        # list of possible columns with data format as text [t]
-        as_text = ['img_file_name',
-                   'object_id',
-                   'object_avi_file',
-                   'object_frame',
-                   'object_line_in_frame',
-                   'object_time',
-                   'object_date',
-                   'sample_id',
-                   'acq_id',
-                   'process_id',
-                   'object_label']
-
-        # for columns in particles_props and with text format, change first row to [t]
-        col_ind_text = [particles_props.columns.get_loc(col) for col in list(set(particles_props.columns) & set(as_text))]
-        for i in col_ind_text:
-            first_row[i] = '[t]'
-
-            
-        # first_row as Dataframe row with appropriate headers
-        first_row = pd.DataFrame(first_row).T
-        first_row.columns = particles_props.columns
-        
-        # concat first_row and dataframe
-        particles_props = pd.concat([first_row, particles_props], ignore_index = True)
-        
-        # initialise, with headers
-        particles_props.to_csv(particles_file,
-            index=False, sep="\t", header=True)
+        with sink.EcotaxaSink(os.path.splitext(particles_file)[0], columns=particles_props.columns) as props_sink:
+            props_sink.write(particles_props)
     else:
         # just append to the file
         with open(particles_file, "a") as outfile:
@@ -181,6 +515,68 @@ def write_particles(particles, destination, px2mm):
         im._save(part, os.path.join(destination, name + ".png"))
     pass
 
+def encode_particle(part, px2mm):
+    """
+    Add a scale bar to a particle and encode it as a png image in memory
+    
+    Args:
+        part (ndarray): particle generated by apeep.measure
+        px2mm (float): size of a pixel in mm
+    
+    Returns:
+        (bytes) content of the png file
+    """
+    part = add_scale(part, px2mm)
+    ok, png = cv2.imencode('.png', im.asimg(part))
+    assert ok, "could not encode particle as png"
+    return(png.tobytes())
+
+def write_particles_tar(particles, particles_props, destination, px2mm, n_threads=4):
+    """
+    Write a set of particles and their properties to a tar archive, ready for ecotaxa
+    
+    Particles are encoded as png on several threads (openCV releases the GIL while
+    encoding) and streamed into the archive, along with the ecotaxa table of their
+    properties, without writing any intermediate file. The archive contains the same
+    files as the directory written by write_particles and write_particles_props.
+    
+    Args:
+        particles (dict): dictionnary of particles generated by apeep.measure
+        particles_props (dataframe): dataframe of particles properties
+            generated by apeep.measure
+        destination (str): path to the tar archive; its name, without extension, is
+            the name of the directory inside the archive
+        px2mm (float): size of a pixel in mm
+        n_threads (int): number of threads to encode particles with (default is 4)
+    
+    Returns:
+        Nothing
+    """
+    sub_dir = os.path.basename(destination).replace('.tar', '')
+    mtime = time.time()
+    
+    def add_file(tar, name, content):
+        info = tarfile.TarInfo(name=sub_dir + '/' + name)
+        info.size = len(content)
+        info.mtime = mtime
+        tar.addfile(info, io.BytesIO(content))
+        pass
+    
+    # write to a temporary file, renamed when complete, to never leave partial archives
+    tmp = destination + '.tmp'
+    with tarfile.open(tmp, 'w') as tar:
+        # encode particles in parallel, and add them in order as they come
+        names = list(particles.keys())
+        pngs = im.prefetch(particles.values(), lambda part: encode_particle(part, px2mm), depth=n_threads)
+        for name, png in zip(names, pngs):
+            add_file(tar, name + '.png', png)
+        
+        # add properties, with the first row of data format codes
+        tsv = sink.ecotaxa_header(particles_props.columns) + particles_props.to_csv(index=False, sep="\t", header=False)
+        add_file(tar, "ecotaxa_particles_" + sub_dir + ".tsv", tsv.encode())
+    os.replace(tmp, destination)
+    pass
+
 # define a custom minimal "font"
 f1 = np.asarray(\
 [[1,1,0,1],\
@@ -223,9 +619,19 @@ t20mm = np.concatenate((f2,f0,fm,fm), axis=1)
 breaks_mm = np.array([1, 10])
 breaks_text = [t1mm, t10mm]
 
-def add_scale(img, px2mm):
-    img_width_px = img.shape[1]
+@functools.lru_cache(maxsize=4096)
+def scale_bar(img_width_px, px2mm, uint8=False):
+    """
+    Draw the scale bar below a particle, cached for each width and resolution
     
+    Args:
+        img_width_px (int): width of the particle, in pixels
+        px2mm (float): size of a pixel in mm
+        uint8 (bool): draw it as uint8 in [0,255] rather than floats in [0,1]
+    
+    Returns:
+        (ndarray) read-only array, 29 px high and at least as wide as the particle
+    """
     # define how large the scale bar is for each physical size,
     # depending on the resolution
     breaks_px = np.round(breaks_mm / px2mm)
@@ -242,24 +648,45 @@ def add_scale(img, px2mm):
     w = max(img_width_px, bar_width_px, text_width_px)
     h = 29
     
-    # pad the input image on the right if it is now wide enough
-    if w > img_width_px:
-        padding = w - img_width_px
-        img = np.pad(img, ((0,0),(0,padding)), constant_values=1)
-    
     # draw a blank scale
     scale = np.ones((h, w))
     # add the scale bar
     scale[slice(h-2,h), slice(0,bar_width_px)] = 0
     # add the text
     scale[slice(h-4-7,h-4), slice(0,text_width_px)] = break_text
+    if uint8:
+        scale = (scale * 255).astype(np.uint8)
+    
+    # protect the cached array
+    scale.flags.writeable = False
+    return(scale)
+
+def add_scale(img, px2mm):
+    """
+    Add a scale bar below a particle
     
-    # combine with the image
-    img = np.concatenate((img, scale), axis=0)
+    The particle and its (cached) scale bar are copied into a single output array,
+    padded with white, rather than padded and concatenated in several copies.
     
-    # add a bit of padding to make it nice
+    Args:
+        img (ndarray): particle, of floats in [0,1] or of uint8
+        px2mm (float): size of a pixel in mm
+    
+    Returns:
+        (ndarray) particle with the scale bar below, padded with white, of the same type
+    """
+    h, img_width_px = img.shape
+    uint8 = img.dtype == np.uint8
+    scale = scale_bar(img_width_px, px2mm, uint8=uint8)
+    w = scale.shape[1]
+    
+    # allocate the output, white, with a bit of padding to make it nice
     # (and make the scale bar 31px high in total, like for zooscan, uvp, etc.)
-    img = np.pad(img, 2, constant_values=1)
-
-    return(img)
+    # NB: the image is padded on the right when the scale is wider
+    out = np.full((h + scale.shape[0] + 4, w + 4), 255 if uint8 else 1, dtype=np.result_type(img.dtype, scale.dtype))
+    
+    # combine the image and the scale
+    out[2:2+h, 2:2+img_width_px] = img
+    out[2+h:-2, 2:-2] = scale
 
+    return(out)
@@ -1,9 +1,76 @@
+import os
+
 import numpy as np
 import skimage.measure
+import scipy.ndimage
 from psd_tools import PSDImage
 
 
-def split_psd(psd_file, min_area=50, alpha_threshold=100):
+def read_psd(psd_file, cache=False, back_only=False):
+    """
+    Read the background and the alpha channel of the mask of a psd image
+    
+    Only the needed channel of each layer is decoded, directly as 8 bits integers,
+    instead of decoding both layers as RGBA floats.
+    
+    Args:
+        psd_file (str): name of psd file
+        cache (bool): store the decoded channels as .npy files next to the psd file
+            and read them from there as long as the psd file is not modified
+            (default is False)
+        back_only (bool): only read the background, not the mask layer (default is False)
+    
+    Returns:
+        back (ndarray): background image, of uint8, rotated of 90° counter clockwise
+        alpha (ndarray): alpha channel of the mask layer, of uint8, rotated of 90° counter clockwise;
+            None when back_only
+    """
+    base = os.path.splitext(psd_file)[0]
+    back_file = base + '_back.npy'
+    alpha_file = base + '_alpha.npy'
+    
+    # read from cache when it is more recent than the psd file
+    if cache and back_only and os.path.exists(back_file) and \
+        os.path.getmtime(back_file) >= os.path.getmtime(psd_file):
+        return(np.load(back_file), None)
+    if cache and os.path.exists(alpha_file) and os.path.exists(back_file) and \
+        os.path.getmtime(alpha_file) >= os.path.getmtime(psd_file):
+        return(np.load(back_file), np.load(alpha_file))
+    
+    # read psd file
+    psd = PSDImage.open(psd_file)
+    # extract the first channel of the back layer (they are all the same)
+    back = np.asarray(psd[0].topil(channel=0, apply_icc=False))
+    back = np.ascontiguousarray(np.rot90(back))
+    if back_only:
+        if cache:
+            _save_npy(back_file, back)
+        return(back, None)
+    # extract the alpha channel of the mask layer
+    alpha = np.asarray(psd[1].topil(channel=-1, apply_icc=False))
+    # rotate both of 90° counter clockwise
+    alpha = np.ascontiguousarray(np.rot90(alpha))
+    
+    if cache:
+        # NB: write alpha last, its modification time marks the cache as complete
+        _save_npy(back_file, back)
+        _save_npy(alpha_file, alpha)
+    
+    return(back, alpha)
+
+def _save_npy(path, x):
+    """
+    Save an array as a .npy file, atomically
+    
+    The array is written to a temporary file, renamed when complete, so that an
+    interrupted write never leaves a truncated file which looks like a valid cache.
+    """
+    tmp = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp, x)
+    os.replace(tmp, path)
+    pass
+
+def split_psd(psd_file, min_area=50, alpha_threshold=100, cache=False, compact=False):
     """
     Split a psd image into mask and background; remove very small particles from mask and label mask.
     
@@ -11,61 +78,108 @@ def split_psd(psd_file, min_area=50, alpha_threshold=100):
         psd_file (str): name of psd file
         min_area (int): minimum size of particles (default is 50)
         alpha_threshold (int): alpha value above which to consider particles (default is 100)
+        cache (bool): cache decoded layers next to the psd file, see read_psd (default is False)
+        compact (bool): return the background as uint8 rather than float (default is False)
     
     Returns:
-        back (1darray): background image
+        back (1darray): background image, of float32 in [0,1] or of uint8 when compact
         mask_labelled_large (1darray): labelled mask without small particles
     """
-    # read psd file
-    psd = PSDImage.open(psd_file)
+    # read background and alpha channel of the mask, as uint8
+    back, mask = read_psd(psd_file, cache=cache)
     
     ## Process background
-    # extract back layer
-    back = psd[0]
-    # convert to numpy array
-    back = back.numpy()
-    
-    #back = np.array(back.topil())
-    
-    # keep only one channel (they are all the same)
-    back = back[:,:,0]
-    # rotate back of 90° counter clockwise
-    back = np.rot90(back)
+    if not compact:
+        back = back_as_float(back)
     
     ## Process mask
-    # extract mask layer
-    mask = psd[1]
-    # convert to numpy array
-    mask = mask.numpy()
-    # extract alpha channel of mask layer
-    mask = mask[:, :, 3]
-    # rotate mask of 90° counter clockwise
-    mask = np.rot90(mask)
-    # multiply by 255 and convert to int
-    mask = (mask*255).astype(np.uint8)
     # threshold particles with alpha level
     mask = mask > alpha_threshold
     
     ## Remove very small particles (likely to be forgotten pixels)
-    # label mask
-    mask_labelled = skimage.measure.label(mask, background=False, connectivity=2)
-    # recreate a labelled image with only large regions
-    regions = skimage.measure.regionprops(mask_labelled)
-    large_regions = [r for r in regions if fast_particle_area(r) > min_area]
-    mask_labelled_large = np.zeros_like(mask_labelled)
+    mask_labelled_large = relabel_large(mask, min_area=min_area)
     
-    # create list of odd numbers for labels to avoid multiple particles with identical labels
-    # If one particle is located inside another one, the sum of their label is an even number, different from every other label.
-    n_large_regions = len(large_regions)
-    labels = range(1, n_large_regions*2+1, 2)
+    return(back, mask_labelled_large)
+
+def back_as_float(back):
+    """
+    Convert a background read as uint8 to float, as psd_tools does
     
-    for i in range(n_large_regions):
-        r = large_regions[i]
-        mask_labelled_large[r._slice] = mask_labelled_large[r._slice] + labels[i]*r.filled_image
+    Args:
+        back (ndarray): background image, of uint8
     
-    return(back, mask_labelled_large)
- 
-def fast_particle_area(x):
-    return(np.sum(x._label_image[x._slice] == x.label))
+    Returns:
+        (ndarray) of float32 in [0,1]
+    """
+    return(back.astype(np.float32) / 255)
 
+def same_image(x, y, step=8):
+    """
+    Check whether two images are identical, from a subsample of their pixels
+    
+    Only one pixel every `step` rows and columns is compared, without copying the 
+    images; this is enough to tell an image from a flipped or different version of it.
+    
+    Args:
+        x, y (ndarray): images
+        step (int): compare one pixel every step rows and columns; 1 compares all pixels
+            (default is 8)
+    
+    Returns:
+        (bool) True when images have the same shape and sampled pixels are equal
+    """
+    if x.shape != y.shape:
+        return(False)
+    return(np.array_equal(x[::step, ::step], y[::step, ::step]))
 
+def relabel_large(mask, min_area=50):
+    """
+    Label particles in a mask, remove small ones and fill holes in the others
+    
+    Large particles are numbered with odd labels, in the order of skimage.measure.label.
+    Holes in a particle are filled with its label and, when a particle is located inside
+    another one, their labels are added: the sum of two odd labels is an even number,
+    different from every other label.
+    
+    All particles are filtered and relabelled at once, with a lookup table; holes are only
+    looked for in particles which enclose some background.
+    
+    Args:
+        mask (ndarray): boolean mask of particles
+        min_area (int): minimum size of particles (default is 50)
+    
+    Returns:
+        (ndarray) labelled mask without small particles
+    """
+    # label mask
+    mask_labelled = skimage.measure.label(mask, background=False, connectivity=2)
+    
+    # compute the area of all particles and keep large ones
+    area = np.bincount(mask_labelled.ravel())
+    large = np.flatnonzero(area > min_area)
+    large = large[large > 0]
+    
+    # relabel large particles with odd numbers and remove others
+    lut = np.zeros(len(area), dtype=mask_labelled.dtype)
+    lut[large] = np.arange(1, len(large)*2+1, 2)
+    mask_labelled_large = lut[mask_labelled]
+    
+    ## Fill holes
+    # holes are made of background enclosed in particles, i.e. not connected to the border of the image
+    back_labelled = skimage.measure.label(~mask, background=False, connectivity=2)
+    border = np.unique(np.concatenate([back_labelled[0,:], back_labelled[-1,:], back_labelled[:,0], back_labelled[:,-1]]))
+    enclosed = (back_labelled > 0) & ~np.isin(back_labelled, border)
+    # particles with holes are those touching enclosed background
+    enclosed = scipy.ndimage.binary_dilation(enclosed, structure=np.ones((3,3)))
+    with_holes = np.unique(mask_labelled[enclosed])
+    with_holes = with_holes[lut[with_holes] > 0]
+    
+    # fill the holes of these particles only, as regionprops' image_filled does
+    slices = scipy.ndimage.find_objects(mask_labelled)
+    for l in with_holes:
+        sl = slices[l-1]
+        particle = mask_labelled[sl] == l
+        holes = scipy.ndimage.binary_fill_holes(particle, structure=np.ones((3,3))) & ~particle
+        mask_labelled_large[sl][holes] += lut[l]
+    
+    return(mask_labelled_large)
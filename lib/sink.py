@@ -0,0 +1,271 @@
+#
+# Streaming writers for tables produced piece by piece
+#
+
+import os
+
+import pandas as pd
+
+class TableSink:
+    """
+    Append tables to a file as they are produced, instead of accumulating them in memory.
+
+    The file is opened once and every table written to it is flushed to disk right away,
+    so that memory use stays flat and partial results survive a crash. The columns of the
+    first non empty table define the columns of the file; following tables are reordered
+    to match them.
+
+    Args:
+        path (str): path to the output file, without extension
+        format (str): 'csv' to write a text file with a header row, 'parquet' to write
+            a columnar file (requires pyarrow) (default is 'csv')
+
+    Example:
+        with TableSink('matches', format='csv') as sink:
+            for df in tables:
+                sink.write(df)
+    """
+    def __init__(self, path, format='csv'):
+        assert format in ('csv', 'parquet'), "`format` should be 'csv' or 'parquet'"
+        self.format = format
+        self.path = path + '.' + format
+        self.columns = None
+        self.n_rows = 0
+        self._writer = None
+
+        if format == 'csv':
+            # (re)create the file, it is filled as tables come
+            self._file = open(self.path, 'w', newline='')
+        else:
+            # import here so that pyarrow is only needed when this format is used
+            import pyarrow
+            import pyarrow.parquet
+            self._pa = pyarrow
+            self._file = None
+            # remove previous output, the writer is created with the first table
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def write(self, df):
+        """
+        Append a table to the file
+
+        Args:
+            df (dataframe): table to append; empty tables are ignored
+        """
+        if df is None or df.shape[1] == 0:
+            return
+
+        # define columns from the first table
+        first = self.columns is None
+        if first:
+            self.columns = list(df.columns)
+        df = df.reindex(columns=self.columns)
+
+        if self.format == 'csv':
+            df.to_csv(self._file, index=False, header=first)
+            self._file.flush()
+        else:
+            if first:
+                table = self._pa.Table.from_pandas(df, preserve_index=False)
+                self._writer = self._pa.parquet.ParquetWriter(self.path, table.schema)
+            else:
+                table = self._pa.Table.from_pandas(df, schema=self._writer.schema, preserve_index=False)
+            self._writer.write_table(table)
+
+        self.n_rows += len(df)
+        pass
+
+    def close(self):
+        """
+        Close the file
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        pass
+
+
+def read_table(path):
+    """
+    Read a table written by a TableSink
+
+    Args:
+        path (str): path to the file, with extension
+
+    Returns:
+        (dataframe) the table, empty when the file is empty or does not exist
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return(pd.DataFrame())
+    if path.endswith('.parquet'):
+        return(pd.read_parquet(path))
+    else:
+        return(pd.read_csv(path))
+
+
+# Columns which contain text in ecotaxa tables; all others are numbers
+ECOTAXA_TEXT_COLUMNS = [
+    'img_file_name',
+    'object_id',
+    'object_avi_file',
+    'object_frame',
+    'object_line_in_frame',
+    'object_time',
+    'object_date',
+    'sample_id',
+    'acq_id',
+    'process_id',
+    'object_label'
+]
+
+def ecotaxa_types(columns):
+    """
+    Get the data format codes of the columns of an ecotaxa table
+
+    Args:
+        columns (list): names of columns
+
+    Returns:
+        (list) '[t]' for text columns and '[f]' for numbers, for each column
+    """
+    return(['[t]' if c in ECOTAXA_TEXT_COLUMNS else '[f]' for c in columns])
+
+def ecotaxa_header(columns):
+    """
+    Format the first two lines of an ecotaxa tsv table: column names and data format codes
+
+    Args:
+        columns (list): names of columns
+
+    Returns:
+        (str) the two lines, as written by pandas
+    """
+    return(pd.DataFrame([ecotaxa_types(columns)], columns=columns).to_csv(index=False, sep='\t', header=True))
+
+class EcotaxaSink:
+    """
+    Write particles properties to an ecotaxa table, as they are produced.
+
+    The file is opened once and its header (column names and data format codes) is
+    written once, from the declared columns or from those of the first table. Tables
+    are then buffered and written in large blocks, reordered to match the columns.
+
+    Args:
+        path (str): path to the output file, without extension
+        columns (list): columns of the table; taken from the first table when None
+        format (str): 'tsv' to write an ecotaxa table, 'parquet' to write a columnar
+            file with text and float columns matching the data format codes
+            (requires pyarrow) (default is 'tsv')
+        buffer_rows (int): number of rows to accumulate before writing them (default is 10000)
+
+    Example:
+        with EcotaxaSink('particles/ecotaxa_particles') as sink:
+            for props in particles_props:
+                sink.write(props)
+    """
+    def __init__(self, path, columns=None, format='tsv', buffer_rows=10000):
+        assert format in ('tsv', 'parquet'), "`format` should be 'tsv' or 'parquet'"
+        self.format = format
+        self.path = path + '.' + format
+        self.buffer_rows = buffer_rows
+        self.columns = None
+        self.n_rows = 0
+        self._buffer = []
+        self._n_buffered = 0
+        self._writer = None
+
+        if format == 'tsv':
+            self._file = open(self.path, 'w', newline='')
+        else:
+            # import here so that pyarrow is only needed when this format is used
+            import pyarrow
+            import pyarrow.parquet
+            self._pa = pyarrow
+            self._file = None
+        if columns is not None:
+            self._set_columns(list(columns))
+
+    def _set_columns(self, columns):
+        self.columns = columns
+        self.types = ecotaxa_types(columns)
+        if self.format == 'tsv':
+            self._file.write(ecotaxa_header(columns))
+        else:
+            # text and floats, as declared by data format codes, which are also stored in metadata
+            pa = self._pa
+            self._schema = pa.schema(
+                [(c, pa.string() if t == '[t]' else pa.float64()) for c,t in zip(columns, self.types)],
+                metadata={'ecotaxa_types': '\t'.join(self.types)}
+            )
+            self._writer = pa.parquet.ParquetWriter(self.path, self._schema)
+        pass
+
+    def write(self, df):
+        """
+        Append a table to the file
+
+        Args:
+            df (dataframe): table to append; empty tables are ignored
+        """
+        if df is None or df.shape[1] == 0:
+            return
+        if self.columns is None:
+            self._set_columns(list(df.columns))
+
+        self._buffer.append(df.reindex(columns=self.columns))
+        self._n_buffered += len(df)
+        if self._n_buffered >= self.buffer_rows:
+            self.flush()
+        pass
+
+    def flush(self):
+        """
+        Write buffered tables to the file
+        """
+        if len(self._buffer) == 0:
+            return
+        df = pd.concat(self._buffer, ignore_index=True)
+        self._buffer = []
+        self._n_buffered = 0
+
+        if self.format == 'tsv':
+            df.to_csv(self._file, index=False, sep='\t', header=False)
+            self._file.flush()
+        else:
+            for c,t in zip(self.columns, self.types):
+                df[c] = df[c].astype(str) if t == '[t]' else df[c].astype(float)
+            self._writer.write_table(self._pa.Table.from_pandas(df, schema=self._schema, preserve_index=False))
+
+        self.n_rows += len(df)
+        pass
+
+    def close(self):
+        """
+        Write remaining tables and close the file
+        """
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        pass
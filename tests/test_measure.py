@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import skimage.measure
+
+import lib.measure as measure
+import lib.segment as segment
+
+def make_stack(seed=0):
+    # background of uint8, as read from a psd file, and labelled mask of a few particles
+    rng = np.random.default_rng(seed)
+    back = rng.integers(0, 256, size=(200, 300), dtype=np.uint8)
+    mask = np.zeros(back.shape, dtype=bool)
+    for r, c, h, w in [(10, 10, 20, 30), (50, 120, 40, 25), (120, 40, 60, 60), (150, 220, 15, 15)]:
+        mask[r:r+h, c:c+w] = rng.random((h, w)) > 0.2
+    return(back, skimage.measure.label(mask))
+
+def test_md5_ids_same_from_uint8_and_float32_backgrounds():
+    back, mask = make_stack()
+    props = ['label', 'area', 'bbox', 'mean_intensity', 'min_intensity', 'max_intensity']
+    particles_uint8, props_uint8 = measure.measure(back, mask, '2021-01-01_10-00-00_000000', 'sample', props=props, id_scheme='md5')
+    particles_float, props_float = measure.measure(segment.back_as_float(back), mask, '2021-01-01_10-00-00_000000', 'sample', props=props, id_scheme='md5')
+
+    # ids are the same
+    assert list(particles_uint8.keys()) == list(particles_float.keys())
+    # particles are written identically
+    for k in particles_uint8:
+        assert particles_uint8[k].dtype == np.uint8
+        assert np.array_equal(particles_uint8[k], (particles_float[k] * 255).astype(np.uint8))
+    # and properties, including intensities, are equal
+    pd.testing.assert_frame_equal(props_uint8, props_float)